@@ -1,47 +1,112 @@
+import time
+PROCESS_STARTED_AT = time.time()
 import os
 import json
 import random
 import string
-import time
 import logging
+import threading
+import sqlite3
+import fcntl
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone, timedelta
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, g, has_request_context, Response
 import firebase_admin
 from firebase_admin import credentials, firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
-import gspread
+from google.api_core.exceptions import AlreadyExists
 import re
-import requests
+import base64
+import hashlib
+import csv
+import io
+import zlib
+import glob
+from gemini_client import GeminiClient, GEMINI_TIMEOUT, GEMINI_MAX_RETRIES, GEMINI_POOL_SIZE, GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_COOLDOWN
 
 # --- 1. Flask 앱 초기화 ---
 app = Flask(__name__, template_folder='templates')
 
 # --- 2. 외부 서비스 초기화 ---
-db = None
-sheet = None
+# Firestore, Sheets, Gemini 클라이언트는 import 시점이 아니라 처음 쓸 때 만든다.
+# 워커가 뜨면 warm_up_services()가 백그라운드에서 미리 만들어 두므로, Sheets가 느리거나 죽어도 워커 기동과 /api/get-test는 막히지 않는다.
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY') 
+SERVICE_RETRY_INTERVAL = float(os.environ.get('SERVICE_RETRY_INTERVAL', 30))
+
+class LazyService:
+    # 처음 쓸 때 factory로 클라이언트를 만들고, 속성 접근은 그 클라이언트로 넘긴다.
+    # 초기화에 실패하면 SERVICE_RETRY_INTERVAL 동안은 다시 시도하지 않고 거짓(False)으로 평가된다. 기존 `if not db:` 검사가 그대로 동작한다.
+    # 다른 스레드(예열 등)가 초기화하는 중이면 실패로 보지 않고 끝날 때까지 기다린다.
+    def __init__(self, name, factory, wrap=None):
+        self._client = None
+        self._name = name
+        self._factory = factory
+        self._wrap = wrap or (lambda client: client)
+        self._lock = threading.Lock()
+        self._failed_at = 0
+        self._attempts = 0
+        self._error = None
+        self._init_seconds = None
+        self._ready_after = None
+
+    def get(self):
+        if self._client is not None: return self._client
+        if self._recently_failed(): return None
+        with self._lock:
+            if self._client is not None or self._recently_failed(): return self._client
+            started = time.time()
+            self._attempts += 1
+            try:
+                self._client = self._wrap(self._factory())
+                self._init_seconds = time.time() - started
+                self._ready_after = time.time() - PROCESS_STARTED_AT
+                self._error = None
+                app.logger.info(f"✅ {self._name} 초기화 성공 ({self._init_seconds:.2f}초)")
+            except Exception as e:
+                self._error = str(e)
+                self._failed_at = time.time()
+                app.logger.error(f"🚨 {self._name} 초기화 실패: {e}", exc_info=True)
+        return self._client
+
+    def _recently_failed(self):
+        return self._error is not None and time.time() - self._failed_at < SERVICE_RETRY_INTERVAL
 
-try:
+    def set(self, client):
+        # 미리 만든 클라이언트(벤치마크용 가짜 객체 등)를 주입한다.
+        self._client = self._wrap(client)
+        self._error = None
+
+    def __bool__(self):
+        return self.get() is not None
+
+    def __getattr__(self, name):
+        client = self.get()
+        if client is None: raise RuntimeError(f"{self._name} 연결 실패: {self._error}")
+        return getattr(client, name)
+
+    def status(self):
+        return {'ready': self._client is not None, 'attempts': self._attempts, 'error': self._error,
+                'initSeconds': self._init_seconds, 'readyAfterStartSeconds': self._ready_after}
+
+def _google_credentials():
     google_creds_json = os.environ.get('GOOGLE_CREDENTIALS_JSON')
-    cred_dict = {}
-    if google_creds_json:
-        cred_dict = json.loads(google_creds_json)
-        
-    if cred_dict:
-        firebase_cred = credentials.Certificate(cred_dict)
-        if not firebase_admin._apps:
-            firebase_admin.initialize_app(firebase_cred)
-        db = firestore.client()
-        app.logger.info("✅ Firebase 초기화 성공")
-
-        gc = gspread.service_account_from_dict(cred_dict)
-        sheet = gc.open("독서력 진단 결과").sheet1
-        app.logger.info("✅ Google Sheets ('독서력 진단 결과') 시트 열기 성공")
-    else:
-        app.logger.warning("🚨 경고: GOOGLE_CREDENTIALS_JSON 환경 변수가 설정되지 않아 DB/Sheet 초기화 실패.")
+    if not google_creds_json: raise RuntimeError("GOOGLE_CREDENTIALS_JSON 환경 변수가 설정되지 않았습니다.")
+    return json.loads(google_creds_json)
+
+def _init_firestore():
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate(_google_credentials()))
+    return firestore.client()
+
+def _init_sheet():
+    import gspread # 무거운 import라 실제로 시트를 열 때 불러온다.
+    gc = gspread.service_account_from_dict(_google_credentials())
+    return gc.open("독서력 진단 결과").sheet1
 
-except Exception as e:
-    app.logger.error(f"🚨 외부 서비스 초기화 실패: {e}", exc_info=True)
+# 두 클라이언트는 호출 지연, 오류, 읽고 쓴 문서 수가 지표에 남도록 InstrumentedClient로 감싼다(12. 지표와 추적).
+db = LazyService('Firebase', _init_firestore, wrap=lambda client: InstrumentedClient(client, 'firestore', FIRESTORE_OPERATIONS, FIRESTORE_CHAIN_METHODS))
+sheet = LazyService("Google Sheets ('독서력 진단 결과')", _init_sheet, wrap=lambda client: InstrumentedClient(client, 'sheets', SHEETS_OPERATIONS))
 
 # --- 3. 핵심 데이터 및 설정 ---
 CATEGORY_MAP = {
@@ -50,6 +115,16 @@ CATEGORY_MAP = {
     "paragraph_ordering": "단락 순서 맞추기", "essay": "창의적 서술력"
 }
 
+AGE_GROUPS = ["10-13", "14-16", "17-19"]
+DIFFICULTIES = ["기초", "표준", "심화"]
+TEST_STRUCTURE = { "title": 2, "theme": 2, "argument": 2, "inference": 2, "pronoun": 2, "sentence_ordering": 2, "paragraph_ordering": 2, "essay": 1 }
+
+def age_group_for(age):
+    age = int(age or 0)
+    if 14 <= age <= 16: return "14-16"
+    if 17 <= age <= 19: return "17-19"
+    return "10-13"
+
 SCORE_CATEGORY_MAP = {
     "title": "정보 이해력", "theme": "정보 이해력", 
     "argument": "비판적 사고력",
@@ -58,6 +133,12 @@ SCORE_CATEGORY_MAP = {
     "essay": "창의적 서술력"
 }
 
+def is_correct_answer(result):
+    # 서술형은 50자 이상 쓰면 정답으로 본다.
+    question = result['question']
+    if question.get('type') == 'essay': return len(result.get('answer', '')) >= 50
+    return result.get('answer') == question.get('answer')
+
 # --- 4. AI 관련 함수 ---
 def get_detailed_prompt(category, age_group, text_content=None, difficulty='표준'):
     difficulty_instruction = ""
@@ -135,16 +216,26 @@ def get_detailed_prompt(category, age_group, text_content=None, difficulty='표
     
     return base_prompt
 
-def call_ai_for_json(prompt, model_name="gemini-2.5-pro"):
-    if not GEMINI_API_KEY: raise ValueError("GEMINI_API_KEY가 설정되지 않았습니다.")
-    url = f"https://generativelanguage.googleapis.com/v1/models/{model_name}:generateContent?key={GEMINI_API_KEY}"
-    headers = {'Content-Type': 'application/json'}
-    data = {'contents': [{'parts': [{'text': prompt}]}]}
-    response = requests.post(url, headers=headers, data=json.dumps(data), timeout=180)
-    response.raise_for_status()
-    result = response.json()
-    if not result.get('candidates'): raise ValueError(f"AI가 유효한 응답을 생성하지 못했습니다. 응답 내용: {result}")
-    raw_text = result['candidates'][0]['content']['parts'][0]['text']
+GENERATION_MAX_WORKERS = int(os.environ.get('GENERATION_MAX_WORKERS', 7))
+GENERATION_DEADLINE = int(os.environ.get('GENERATION_DEADLINE', 240))
+
+def _on_gemini_event(event, model_name, elapsed=None, error=None, usage=None):
+    # GeminiClient의 호출/재시도/차단 알림을 지표로 옮긴다(12. 지표와 추적).
+    if event == 'call':
+        record_dependency_call('gemini', model_name, elapsed, error)
+        for kind, field in (('prompt', 'promptTokenCount'), ('candidates', 'candidatesTokenCount')):
+            if usage.get(field): metrics.inc('gemini_tokens_total', usage[field], model=model_name, kind=kind)
+    else:
+        metrics.inc({'retry': 'gemini_retries_total', 'rejected': 'gemini_rejected_total'}[event], model=model_name)
+
+gemini = LazyService('Gemini', lambda: GeminiClient(GEMINI_API_KEY, GEMINI_TIMEOUT, GEMINI_MAX_RETRIES, GEMINI_POOL_SIZE, GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_COOLDOWN,
+                                                       logger=app.logger, on_event=_on_gemini_event))
+
+def call_ai_for_json(prompt, model_name="gemini-2.5-pro", timeout=None, deadline=None):
+    raw_text, _ = gemini.generate(prompt, model_name, timeout, deadline)
+    return parse_ai_json(raw_text)
+
+def parse_ai_json(raw_text):
     match = re.search(r'```json\s*([\s\S]+?)\s*```', raw_text)
     if match:
         json_str = match.group(1)
@@ -155,18 +246,846 @@ def call_ai_for_json(prompt, model_name="gemini-2.5-pro"):
         except json.JSONDecodeError:
             raise ValueError(f"AI가 유효한 JSON을 생성하지 못했습니다: {raw_text}")
 
-def call_ai_for_text(prompt, model_name="gemini-2.5-pro"):
-    if not GEMINI_API_KEY: raise ValueError("GEMINI_API_KEY가 설정되지 않았습니다.")
-    url = f"https://generativelanguage.googleapis.com/v1/models/{model_name}:generateContent?key={GEMINI_API_KEY}"
-    headers = {'Content-Type': 'application/json'}
-    data = {'contents': [{'parts': [{'text': prompt}]}]}
-    response = requests.post(url, headers=headers, data=json.dumps(data), timeout=180)
-    response.raise_for_status()
-    result = response.json()
-    if not result.get('candidates'): raise ValueError(f"AI가 유효한 응답을 생성하지 못했습니다. 응답 내용: {result}")
-    return result['candidates'][0]['content']['parts'][0]['text']
-
-# --- 5. 라우팅 (API 엔드포인트) ---
+def call_ai_for_text(prompt, model_name="gemini-2.5-pro", timeout=None, deadline=None):
+    text, _ = gemini.generate(prompt, model_name, timeout, deadline)
+    return text
+
+def generate_question(category, age_group, text_content=None, difficulty='표준', deadline=None, model_name="gemini-2.5-pro", exclude_id=None):
+    # (문제 데이터, 캐시 후보 id)를 돌려준다. 호출자는 문제를 저장한 뒤 ai_cache.mark_served(후보 id)를 불러야 한다.
+    # 문제 은행에 비슷한 지문이 있으면 그 소재를 피하라고 덧붙여 DEDUP_MAX_ATTEMPTS번까지 다시 만들고, 그래도 겹치면 DuplicatePassageError를 낸다.
+    # exclude_id는 재생성처럼 자기 자신과의 비교를 빼야 할 때 쓴다.
+    avoid = None
+    for attempt in range(DEDUP_MAX_ATTEMPTS + 1):
+        prompt = get_detailed_prompt(category, age_group, text_content, difficulty)
+        if avoid: prompt += f"\n[중복 방지] 아래 지문과 소재와 내용이 겹치지 않는 새로운 지문을 써줘.\n{avoid}...\n"
+        cached = ai_cache.take(prompt, model_name)
+        if cached:
+            question_data, candidate_id = cached
+        else:
+            raw_text, usage = gemini.generate(prompt, model_name, deadline=deadline)
+            question_data = parse_ai_json(raw_text)
+            question_data['difficulty'] = difficulty # 난이도 정보 추가
+
+            required_keys = ['passage', 'question']
+            if question_data.get('type') == 'multiple_choice':
+                required_keys.extend(['options', 'answer'])
+            if not all(key in question_data for key in required_keys):
+                 raise ValueError("AI 생성 데이터에 필수 키 누락")
+            candidate_id = ai_cache.put(prompt, model_name, question_data, usage)
+
+        duplicate = passage_index.reserve(question_data, exclude_id) if DEDUP_ENABLED else None
+        if not duplicate: return question_data, candidate_id
+        # 중복 후보는 캐시에서 다시 꺼내 쓰지 않도록 소비한 것으로 표시한다.
+        ai_cache.mark_served(candidate_id)
+        duplicate_id, similarity, avoid = duplicate
+        app.logger.warning(f"중복 지문 감지 ({category}/{age_group}, 기존 문제 {duplicate_id}, 유사도 {similarity:.2f}, {attempt + 1}회차)")
+        if attempt < DEDUP_MAX_ATTEMPTS: passage_index.stats['regenerations'] += 1
+    passage_index.stats['rejected'] += 1
+    raise DuplicatePassageError(f"기존 문제({duplicate_id})와 지문이 너무 비슷합니다 (유사도 {similarity:.2f}).")
+
+# --- 5. 문제 은행 캐시 ---
+# (targetAge, category) 별로 문제를 프로세스 메모리에 색인해 두고, 시험지 구성 시 Firestore를 읽지 않는다.
+# TTL이 지나거나 문제 생성/삭제/재생성으로 무효화되면 다음 요청에서 컬렉션을 한 번만 다시 읽는다.
+QUESTION_CACHE_TTL = int(os.environ.get('QUESTION_CACHE_TTL', 300))
+QUESTION_CACHE_WAIT = float(os.environ.get('QUESTION_CACHE_WAIT', 2))
+
+class QuestionIndex:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._loaded_at = None
+        self._invalidated = True
+        self.version = 0 # 다시 읽을 때마다 올라간다. 중복 지문 색인이 다시 만들 때를 판단하는 데 쓴다.
+        self.stats = {'hits': 0, 'misses': 0, 'reloads': 0, 'reload_errors': 0, 'invalidations': 0, 'stale_serves': 0}
+
+    def _is_fresh(self):
+        return not self._invalidated and self._loaded_at is not None and time.time() - self._loaded_at < self.ttl
+
+    def _reload(self):
+        buckets = {}
+        for doc in db.collection('questions').stream():
+            q = doc.to_dict()
+            q['id'] = doc.id
+            buckets.setdefault((q.get('targetAge'), q.get('category')), []).append(q)
+        self._buckets = buckets
+        self._loaded_at = time.time()
+        self._invalidated = False
+        self.version += 1
+        self.stats['reloads'] += 1
+        app.logger.info(f"문제 은행 캐시 갱신: {sum(len(v) for v in buckets.values())}개 문항, {len(buckets)}개 버킷")
+
+    def _ensure_loaded(self):
+        if self._is_fresh():
+            self.stats['hits'] += 1
+            return
+        # 다른 요청이 다시 읽는 중이면 기다리지 않고 이전 색인을 쓴다. 색인이 아직 없으면 QUESTION_CACHE_WAIT까지만 기다린다.
+        if not self._lock.acquire(timeout=QUESTION_CACHE_WAIT if self._loaded_at is None else 0):
+            if self._loaded_at is None: raise TimeoutError("문제 은행을 불러오는 중입니다.")
+            self.stats['stale_serves'] += 1
+            return
+        try:
+            if self._is_fresh():
+                self.stats['hits'] += 1
+                return
+            self.stats['misses'] += 1
+            try:
+                self._reload()
+            except Exception:
+                self.stats['reload_errors'] += 1
+                if self._loaded_at is None: raise
+                # 갱신에 실패해도 이전 색인이 있으면 그대로 사용한다.
+                self.stats['stale_serves'] += 1
+                app.logger.error("문제 은행 캐시 갱신 실패, 이전 색인 사용", exc_info=True)
+        finally:
+            self._lock.release()
+
+    def sample_test(self, age_group, test_structure):
+        self._ensure_loaded()
+        questions = []
+        for category, needed_count in test_structure.items():
+            bucket = self._buckets.get((age_group, category), [])
+            # get_test가 title 등을 덮어쓰므로 캐시 원본 대신 사본을 돌려준다.
+            questions.extend(dict(q) for q in random.sample(bucket, min(needed_count, len(bucket))))
+        return questions
+
+    def depths(self):
+        self._ensure_loaded()
+        depths = {}
+        for (age_group, category), bucket in self._buckets.items():
+            for q in bucket:
+                key = (age_group, category, q.get('difficulty', '표준'))
+                depths[key] = depths.get(key, 0) + 1
+        return depths
+
+    def passages(self):
+        self._ensure_loaded()
+        return self.version, [(q['id'], q.get('targetAge'), q.get('passage', '')) for bucket in self._buckets.values() for q in bucket]
+
+    def invalidate(self):
+        self._invalidated = True
+        self.stats['invalidations'] += 1
+
+    def snapshot_stats(self):
+        age = time.time() - self._loaded_at if self._loaded_at else None
+        total = self.stats['hits'] + self.stats['misses']
+        return {**self.stats,
+                'hit_ratio': self.stats['hits'] / total if total else 0,
+                'age_seconds': age, 'stale': not self._is_fresh(), 'ttl_seconds': self.ttl,
+                'buckets': {f"{a}/{c}": len(v) for (a, c), v in self._buckets.items()}}
+
+question_index = QuestionIndex(QUESTION_CACHE_TTL)
+
+# --- 6. 백그라운드 작업 큐 ---
+# AI 생성 작업은 HTTP 요청 안에서 실행하지 않고 SQLite 파일에 기록한 뒤 전용 작업 스레드가 처리한다.
+# 같은 호스트의 gunicorn 워커들이 파일을 공유하므로 어느 워커든 진행 상황을 조회할 수 있고,
+# 실행 중 프로세스가 죽은 작업은 heartbeat가 끊긴 뒤 다른 작업 스레드가 이어서 처리한다.
+JOB_DB_PATH = os.environ.get('JOB_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.sqlite3'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# 결과 보고서 작업은 시험 당일 학생 수만큼 몰리고 대부분 AI 응답을 기다리므로, 관리자 작업 뒤에 줄 서지 않도록 전용 스레드를 따로 둔다.
+REPORT_JOB_WORKERS = int(os.environ.get('REPORT_JOB_WORKERS', 16))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', 600))
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', JOB_STALE_SECONDS / 4))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', 7 * 24 * 3600))
+
+_sqlite_local = threading.local()
+
+def local_sqlite():
+    # sqlite3 연결은 스레드 간에 공유하지 않는다. fork된 워커는 새로 연결한다.
+    conn = getattr(_sqlite_local, 'conn', None)
+    if conn is None or getattr(_sqlite_local, 'pid', None) != os.getpid():
+        conn = sqlite3.connect(JOB_DB_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        _sqlite_local.conn, _sqlite_local.pid = conn, os.getpid()
+    return conn
+
+class RetryLater(Exception):
+    # 핸들러가 자체적으로 재시도 횟수를 관리할 때 던진다. JOB_MAX_ATTEMPTS에 포함되지 않는다.
+    def __init__(self, message, delay):
+        super().__init__(message)
+        self.delay = delay
+
+class JobQueue:
+    def __init__(self, workers, dedicated=None):
+        # dedicated: {작업 유형: 스레드 수}. 해당 유형은 전용 스레드만 처리하고, 나머지 유형은 공용 스레드(workers)가 처리한다.
+        self.workers = workers
+        self.dedicated = dedicated or {}
+        self._handlers = {}
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._last_purge = 0
+        self._running = set()
+        self._running_lock = threading.Lock()
+        conn = local_sqlite()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL,
+            payload TEXT NOT NULL, progress TEXT NOT NULL, result TEXT, error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0, run_after REAL NOT NULL,
+            created_at REAL NOT NULL, updated_at REAL NOT NULL, heartbeat_at REAL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_idx ON jobs (status, run_after)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_kind_status_idx ON jobs (kind, status, run_after)")
+
+    def handler(self, kind):
+        def decorator(func):
+            self._handlers[kind] = func
+            return func
+        return decorator
+
+    def enqueue(self, kind, payload, progress=None, delay=0):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        local_sqlite().execute(
+            "INSERT INTO jobs (id, kind, status, payload, progress, run_after, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)",
+            (job_id, kind, json.dumps(payload, ensure_ascii=False), json.dumps(progress or {}, ensure_ascii=False), now + delay, now, now))
+        self.start()
+        return job_id
+
+    def get(self, job_id):
+        row = local_sqlite().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row: return None
+        return {'id': row['id'], 'kind': row['kind'], 'status': row['status'],
+                'payload': json.loads(row['payload']), 'progress': json.loads(row['progress']),
+                'result': json.loads(row['result']) if row['result'] else None, 'error': row['error'],
+                'attempts': row['attempts'], 'createdAt': row['created_at'], 'updatedAt': row['updated_at']}
+
+    def set_progress(self, job_id, progress):
+        now = time.time()
+        local_sqlite().execute("UPDATE jobs SET progress = ?, updated_at = ?, heartbeat_at = ? WHERE id = ?",
+                             (json.dumps(progress, ensure_ascii=False), now, now, job_id))
+
+    def update_progress(self, job_id, mutate):
+        # 진행 상황을 읽고-고치고-쓰는 과정을 한 트랜잭션으로 묶는다. mutate가 False를 돌려주면 아무것도 바꾸지 않고 None을 돌려준다.
+        conn = local_sqlite()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT progress FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            progress = json.loads(row['progress']) if row else None
+            if progress is None or mutate(progress) is False:
+                conn.execute("ROLLBACK")
+                return None
+            now = time.time()
+            conn.execute("UPDATE jobs SET progress = ?, updated_at = ?, heartbeat_at = ? WHERE id = ?", (json.dumps(progress, ensure_ascii=False), now, now, job_id))
+            conn.execute("COMMIT")
+            return progress
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def wake(self, job_id):
+        # 대기 중인 작업을 바로 실행 대상으로 만든다.
+        local_sqlite().execute("UPDATE jobs SET run_after = 0 WHERE id = ? AND status = 'queued'", (job_id,))
+
+    def _claim(self, kinds=(), exclude=()):
+        conn = local_sqlite()
+        now = time.time()
+        kind_filter, params = '', ()
+        if kinds:
+            kind_filter, params = f" AND kind IN ({', '.join('?' * len(kinds))})", tuple(kinds)
+        elif exclude:
+            kind_filter, params = f" AND kind NOT IN ({', '.join('?' * len(exclude))})", tuple(exclude)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                f"SELECT * FROM jobs WHERE ((status = 'queued' AND run_after <= ?) OR (status = 'running' AND heartbeat_at < ?)){kind_filter} ORDER BY created_at LIMIT 1",
+                (now, now - JOB_STALE_SECONDS) + params).fetchone()
+            if row:
+                conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, heartbeat_at = ?, updated_at = ? WHERE id = ?", (now, now, row['id']))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return self.get(row['id']) if row else None
+
+    def _finish(self, job_id, status, result=None, error=None, retry_in=None):
+        now = time.time()
+        if retry_in is not None:
+            local_sqlite().execute("UPDATE jobs SET status = 'queued', error = ?, run_after = ?, updated_at = ? WHERE id = ?", (error, now + retry_in, now, job_id))
+            return
+        local_sqlite().execute("UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?",
+                             (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, now, job_id))
+
+    def _purge(self):
+        if time.time() - self._last_purge < 3600: return
+        self._last_purge = time.time()
+        local_sqlite().execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (time.time() - JOB_RETENTION_SECONDS,))
+
+    def run_pending(self, kinds=(), exclude=()):
+        job = self._claim(kinds, exclude)
+        if not job: return False
+        handler = self._handlers.get(job['kind'])
+        with self._running_lock: self._running.add(job['id'])
+        try:
+            if not handler: raise ValueError(f"알 수 없는 작업 유형: {job['kind']}")
+            self._finish(job['id'], 'done', result=handler(job))
+        except RetryLater as e:
+            app.logger.warning(f"작업 재시도 예약: {job['kind']} ({job['id']}): {e}")
+            self._finish(job['id'], 'queued', error=str(e), retry_in=e.delay)
+        except Exception as e:
+            app.logger.error(f"작업 실패: {job['kind']} ({job['id']}, {job['attempts']}회차): {e}", exc_info=True)
+            if job['attempts'] < JOB_MAX_ATTEMPTS:
+                self._finish(job['id'], 'queued', error=str(e), retry_in=2 ** job['attempts'] * 10)
+            else:
+                self._finish(job['id'], 'failed', error=str(e))
+        finally:
+            with self._running_lock: self._running.discard(job['id'])
+        return True
+
+    def _heartbeat_loop(self):
+        # 핸들러가 진행 상황을 남기지 않고 오래 걸려도(AI 호출 재시도 등) 살아 있는 작업이 다른 스레드에 다시 선점되지 않게 한다.
+        # 프로세스가 죽으면 이 스레드도 멈추므로 heartbeat가 끊긴 작업은 그대로 이어받아진다.
+        while True:
+            time.sleep(JOB_HEARTBEAT_INTERVAL)
+            with self._running_lock: running = list(self._running)
+            if not running: continue
+            try:
+                now = time.time()
+                local_sqlite().executemany("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'", [(now, job_id) for job_id in running])
+            except Exception:
+                app.logger.error("작업 heartbeat 갱신 실패", exc_info=True)
+
+    def _worker_loop(self, kinds=(), exclude=()):
+        while True:
+            try:
+                if not self.run_pending(kinds, exclude):
+                    self._purge()
+                    time.sleep(JOB_POLL_INTERVAL)
+            except Exception:
+                app.logger.error("작업 스레드 오류", exc_info=True)
+                time.sleep(JOB_POLL_INTERVAL)
+
+    def start(self):
+        # gunicorn이 fork한 워커마다 자기 작업 스레드를 띄운다.
+        if self._started_pid == os.getpid(): return
+        with self._start_lock:
+            if self._started_pid == os.getpid(): return
+            for i in range(self.workers):
+                threading.Thread(target=self._worker_loop, args=((), tuple(self.dedicated)), name=f"job-worker-{i}", daemon=True).start()
+            for kind, count in self.dedicated.items():
+                for i in range(count):
+                    threading.Thread(target=self._worker_loop, args=((kind,),), name=f"job-worker-{kind}-{i}", daemon=True).start()
+            threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True).start()
+            self._started_pid = os.getpid()
+
+job_queue = JobQueue(JOB_WORKERS, {'report': REPORT_JOB_WORKERS})
+
+def _release_unsaved(items):
+    # generate_question 결과 중 저장하지 못한 (문제 데이터, 캐시 후보 id)의 중복 지문 예약과 캐시 임대를 푼다.
+    for question_data, candidate_id in items:
+        passage_index.release(question_data)
+        ai_cache.release(candidate_id)
+
+QUESTION_SET_CATEGORIES = ["title", "theme", "argument", "inference", "pronoun", "sentence_ordering", "paragraph_ordering"]
+
+@job_queue.handler('question_set')
+def run_question_set_job(job):
+    if not db: raise RuntimeError("DB 연결 실패")
+    payload, progress = job['payload'], job['progress']
+    age_group, difficulty, text_content = payload['ageGroup'], payload['difficulty'], payload.get('textContent')
+    # 재시작된 작업이면 이미 성공한 유형은 건너뛴다.
+    pending = [c for c in QUESTION_SET_CATEGORIES if progress[c]['status'] != '성공']
+
+    generated, candidates, saved = {}, {}, set()
+    try:
+        # 유형별 AI 호출을 동시에 보내, 전체 소요 시간이 가장 느린 호출 하나에 가깝도록 한다.
+        deadline = time.time() + GENERATION_DEADLINE
+        with ThreadPoolExecutor(max_workers=GENERATION_MAX_WORKERS) as executor:
+            futures = {}
+            for category in pending:
+                app.logger.info(f"일괄 생성 중: Category: {category}, Age: {age_group}, Difficulty: {difficulty}")
+                futures[executor.submit(generate_question, category, age_group, text_content, difficulty, deadline)] = category
+                progress[category] = {"category": CATEGORY_MAP.get(category), "status": "생성 중"}
+            job_queue.set_progress(job['id'], progress)
+
+            for future in as_completed(futures):
+                category = futures[future]
+                try:
+                    generated[category], candidates[category] = future.result()
+                    progress[category] = {"category": CATEGORY_MAP.get(category), "status": "저장 대기"}
+                except Exception as e:
+                    app.logger.error(f"'{category}' 유형 생성 실패: {e}")
+                    progress[category] = {"category": CATEGORY_MAP.get(category), "status": "실패", "reason": str(e)}
+                job_queue.set_progress(job['id'], progress)
+
+        # 생성된 문제는 한 번에 저장한다.
+        refs = {category: db.collection('questions').document() for category in generated}
+        _, failed = bulk_write([('create', refs[category], question_data) for category, question_data in generated.items()])
+        failed_ids = {f['id']: f['error'] for f in failed}
+        for category, ref in refs.items():
+            if ref.id in failed_ids:
+                progress[category] = {"category": CATEGORY_MAP.get(category), "status": "실패", "reason": f"저장 실패: {failed_ids[ref.id]}"}
+            else:
+                progress[category] = {"category": CATEGORY_MAP.get(category), "status": "성공"}
+                ai_cache.mark_served(candidates[category])
+                passage_index.commit(ref.id, generated[category])
+                saved.add(category)
+        if refs: question_index.invalidate()
+        job_queue.set_progress(job['id'], progress)
+    finally:
+        # 저장하지 못한 문제(생성 후 저장 실패, 작업 중단)의 예약을 풀어 재시도 때 다시 쓸 수 있게 한다.
+        _release_unsaved((generated[c], candidates[c]) for c in generated if c not in saved)
+
+    return {"results": [progress[c] for c in QUESTION_SET_CATEGORIES]}
+
+@job_queue.handler('regenerate_question')
+def run_regenerate_question_job(job):
+    if not db: raise RuntimeError("DB 연결 실패")
+    question_id = job['payload']['id']
+    doc_ref = db.collection('questions').document(question_id)
+    old_doc = doc_ref.get()
+    if not old_doc.exists:
+        return {"success": False, "message": "문서를 찾을 수 없습니다."}
+
+    old_data = old_doc.to_dict()
+    category = old_data.get('category')
+    age_group = old_data.get('targetAge')
+    difficulty = old_data.get('difficulty', '표준') # 기존 난이도 유지
+
+    new_question_data, candidate_id = generate_question(category, age_group, None, difficulty, exclude_id=question_id)
+    try:
+        doc_ref.update(new_question_data)
+    except Exception:
+        _release_unsaved([(new_question_data, candidate_id)])
+        raise
+    ai_cache.mark_served(candidate_id)
+    passage_index.commit(question_id, {**old_data, **new_question_data})
+    question_index.invalidate()
+    app.logger.info(f"문제 재생성 성공: ID {question_id}")
+    return {"success": True, "message": "문제를 성공적으로 다시 생성했습니다."}
+
+REPORT_STEP_MAX_ATTEMPTS = int(os.environ.get('REPORT_STEP_MAX_ATTEMPTS', 5))
+REPORT_FALLBACK_TEXT = "AI 리포트 생성에 실패했습니다. 기본 리포트를 표시합니다."
+# 스트리밍을 요청한 제출은 이 시간만큼 백그라운드 작업을 늦춰, 브라우저가 먼저 보고서 작성을 맡을 수 있게 한다.
+REPORT_STREAM_GRACE = float(os.environ.get('REPORT_STREAM_GRACE', 10))
+# 이 시간이 지나도록 끝나지 않은 스트림은 끊긴 것으로 보고 백그라운드 작업이 이어받는다.
+REPORT_STREAM_CLAIM_TTL = GEMINI_TIMEOUT + 60
+# 열린 스트림은 AI 생성이 끝날 때까지 gthread 스레드 하나를 붙잡는다. 시험지/제출 요청이 쓸 스레드를 남기도록
+# 프로세스당 동시 스트림 수를 제한하고, 넘치면 /api/report-status 폴링으로 돌려보낸다.
+REPORT_STREAM_MAX_CONCURRENCY = int(os.environ.get('REPORT_STREAM_MAX_CONCURRENCY', 3))
+_report_stream_slots = threading.BoundedSemaphore(REPORT_STREAM_MAX_CONCURRENCY)
+
+def _report_step_narrative(job_id, payload, progress):
+    try:
+        return {'reportText': generate_dynamic_report_from_ai(payload['userInfo'].get('name'), payload['scores'], payload['metacognition'], len(payload['results']), payload['correctCount'])}
+    except Exception:
+        if progress['steps']['narrative']['attempts'] + 1 < REPORT_STEP_MAX_ATTEMPTS: raise
+        # 마지막 시도까지 실패하면 기본 문구로 보고서를 마무리한다.
+        app.logger.error("AI 동적 리포트 생성 실패, 기본 리포트로 대체", exc_info=True)
+        return {'reportText': REPORT_FALLBACK_TEXT}
+
+def _report_step_save(job_id, payload, progress):
+    if not db: raise RuntimeError("DB 연결 실패")
+    dimensions = analytics_dimensions(payload['userInfo'], payload['timestamp'])
+    report_data = { "userInfo": payload['userInfo'], "results": payload['results'], "scores": payload['scores'], "metacognition": payload['metacognition'], "reportText": progress['reportText'], "recommendations": payload['recommendations'], "timestamp": payload['timestamp'],
+                    "correctCount": payload['correctCount'], "totalQuestions": len(payload['results']), "analytics": dimensions }
+    # 보고서 생성과 코호트 집계 증가를 한 배치로 묶는다. 작업 id를 문서 id로 create 하므로,
+    # 재시도 때 이미 있으면 배치 전체가 거절되어 보고서도 집계도 한 번만 반영된다.
+    batch = db.batch()
+    batch.create(db.collection('reports').document(job_id), report_data)
+    add_report_to_rollup(batch, dimensions, payload['scores'], payload['metacognition'], payload['correctCount'], len(payload['results']))
+    try:
+        batch.commit()
+    except AlreadyExists:
+        app.logger.info(f"이미 저장된 보고서: {job_id}")
+
+def _report_step_sheet(job_id, payload, progress):
+    sheet_exporter.enqueue(payload['sheetRow'])
+
+# (단계 이름, 실행 함수, 선행 단계)
+REPORT_STEPS = [('narrative', _report_step_narrative, None), ('save', _report_step_save, 'narrative'), ('sheet', _report_step_sheet, None)]
+
+def _claim_report_step(name, owner, depends_on=None):
+    # 단계를 owner('running' 또는 'streaming')로 선점한다. 이미 끝났거나 다른 쪽이 진행 중이면 False를 돌려준다.
+    def mutate(progress):
+        state = progress['steps'][name]
+        if state['status'] == 'done' or (depends_on and progress['steps'][depends_on]['status'] != 'done'): return False
+        if state['status'] in ('running', 'streaming') and time.time() - state.get('claimedAt', 0) < REPORT_STREAM_CLAIM_TTL: return False
+        state.update(status=owner, claimedAt=time.time())
+    return mutate
+
+def _finish_report_step(name, updates=None, error=None):
+    def mutate(progress):
+        state = progress['steps'][name]
+        progress.update(updates or {})
+        if error is None:
+            state.update(status='done', error=None)
+        else:
+            state['attempts'] += 1
+            state.update(status='failed' if state['attempts'] >= REPORT_STEP_MAX_ATTEMPTS else 'retrying', error=error)
+    return mutate
+
+@job_queue.handler('report')
+def run_report_job(job):
+    # 단계별로 상태를 기록해, 실패한 단계만 다시 시도한다. 스트리밍 요청이 보고서 작성을 맡고 있으면 그 단계는 건너뛴다.
+    payload = job['payload']
+    retry_delays = []
+    for name, step, depends_on in REPORT_STEPS:
+        progress = job_queue.update_progress(job['id'], _claim_report_step(name, 'running', depends_on))
+        if progress is None: continue
+        try:
+            progress = job_queue.update_progress(job['id'], _finish_report_step(name, step(job['id'], payload, progress)))
+        except Exception as e:
+            progress = job_queue.update_progress(job['id'], _finish_report_step(name, error=str(e)))
+            state = progress['steps'][name]
+            app.logger.error(f"결과 처리 단계 실패: {name} ({job['id']}, {state['attempts']}회차): {e}")
+            if state['status'] == 'retrying': retry_delays.append(2 ** state['attempts'] * 5)
+
+    steps = job_queue.get(job['id'])['progress']['steps']
+    if any(state['status'] not in ('done', 'failed') for state in steps.values()):
+        raise RetryLater("일부 결과 처리 단계 재시도 대기", min(retry_delays) if retry_delays else 5)
+    return {name: state['status'] for name, state in steps.items()}
+
+# --- 7. Google Sheets 내보내기 ---
+# 결과 행을 로컬 SQLite 스풀에 먼저 쌓고, 건수 또는 시간 기준을 채우면 append_rows 한 번으로 묶어서 보낸다.
+# 여러 워커 중 파일 잠금을 잡은 한 프로세스만 전송하므로 스풀 순서대로 기록된다.
+# 전송 후 스풀 삭제 전에 프로세스가 죽으면 같은 행이 한 번 더 기록될 수 있다(최소 한 번 전달).
+SHEET_BATCH_SIZE = int(os.environ.get('SHEET_BATCH_SIZE', 50))
+SHEET_FLUSH_INTERVAL = float(os.environ.get('SHEET_FLUSH_INTERVAL', 10))
+SHEET_MAX_BACKOFF = float(os.environ.get('SHEET_MAX_BACKOFF', 300))
+
+class SheetExporter:
+    def __init__(self, batch_size, flush_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._flush_lock = threading.Lock() # 전송 스레드와 강제 전송(flush(force=True))이 같은 행을 두 번 보내지 않게 한다.
+        self._backoff = 0
+        self._retry_at = 0
+        self.stats = {'flushes': 0, 'rows_flushed': 0, 'last_flush_size': 0, 'last_flush_at': None, 'last_flush_lag_seconds': 0,
+                      'flush_errors': 0, 'quota_errors': 0, 'last_error': None}
+        local_sqlite().execute("CREATE TABLE IF NOT EXISTS sheet_spool (id INTEGER PRIMARY KEY AUTOINCREMENT, row TEXT NOT NULL, enqueued_at REAL NOT NULL)")
+
+    def enqueue(self, row):
+        local_sqlite().execute("INSERT INTO sheet_spool (row, enqueued_at) VALUES (?, ?)", (json.dumps(row, ensure_ascii=False), time.time()))
+
+    def _spool_state(self):
+        row = local_sqlite().execute("SELECT COUNT(*) AS depth, MIN(enqueued_at) AS oldest FROM sheet_spool").fetchone()
+        return row['depth'], row['oldest']
+
+    def flush(self, force=False):
+        with self._flush_lock:
+            return self._flush(force)
+
+    def _flush(self, force):
+        if time.time() < self._retry_at: return 0
+        depth, oldest = self._spool_state()
+        if not depth or not (force or depth >= self.batch_size or time.time() - oldest >= self.flush_interval): return 0
+        if not sheet: return 0
+
+        rows = local_sqlite().execute("SELECT id, row, enqueued_at FROM sheet_spool ORDER BY id LIMIT ?", (self.batch_size,)).fetchall()
+        try:
+            sheet.append_rows([json.loads(r['row']) for r in rows])
+        except Exception as e:
+            quota = getattr(getattr(e, 'response', None), 'status_code', None) == 429
+            self.stats['quota_errors' if quota else 'flush_errors'] += 1
+            self.stats['last_error'] = str(e)
+            self._backoff = min(SHEET_MAX_BACKOFF, max(self.flush_interval, self._backoff * 2))
+            self._retry_at = time.time() + self._backoff
+            app.logger.error(f"시트 일괄 기록 실패 ({len(rows)}행), {self._backoff:.0f}초 후 재시도: {e}")
+            return 0
+        local_sqlite().execute("DELETE FROM sheet_spool WHERE id <= ?", (rows[-1]['id'],))
+        self._backoff = 0
+        self.stats.update(flushes=self.stats['flushes'] + 1, rows_flushed=self.stats['rows_flushed'] + len(rows),
+                          last_flush_size=len(rows), last_flush_at=time.time(), last_flush_lag_seconds=time.time() - rows[0]['enqueued_at'])
+        return len(rows)
+
+    def _flush_loop(self):
+        with open(JOB_DB_PATH + '.sheet.lock', 'w') as lock_file:
+            # 다른 워커가 이미 전송을 맡고 있으면 잠금이 풀릴 때까지 기다린다.
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            while True:
+                try:
+                    # 한 번에 batch_size까지만 보내므로, 스풀이 밀려 있으면 쉬지 않고 이어서 보낸다.
+                    if self.flush() < self.batch_size: time.sleep(1)
+                except Exception:
+                    app.logger.error("시트 내보내기 스레드 오류", exc_info=True)
+                    time.sleep(self.flush_interval)
+
+    def start(self):
+        if self._started_pid == os.getpid(): return
+        with self._start_lock:
+            if self._started_pid == os.getpid(): return
+            threading.Thread(target=self._flush_loop, name="sheet-exporter", daemon=True).start()
+            self._started_pid = os.getpid()
+
+    def snapshot_stats(self):
+        depth, oldest = self._spool_state()
+        return {**self.stats, 'spool_depth': depth, 'lag_seconds': time.time() - oldest if oldest else 0,
+                'backoff_seconds': max(0, self._retry_at - time.time())}
+
+sheet_exporter = SheetExporter(SHEET_BATCH_SIZE, SHEET_FLUSH_INTERVAL)
+
+# --- 8. 문제 재고 관리 ---
+# 시험지는 난이도를 가리지 않으므로 연령대 × 유형 버킷별 문항 수를 감시하다가, 하한선 아래로 내려간 버킷은 백그라운드 생성 작업으로 채운다.
+# 하한선은 시험지 한 장에 필요한 문항 수(TEST_STRUCTURE)의 INVENTORY_WATERMARK_FACTOR배이고, INVENTORY_WATERMARKS로 버킷별로 바꿀 수 있다.
+# AI 비용은 시간당 생성 작업 수(INVENTORY_REFILL_BUDGET)로 묶고, 파일 잠금을 잡은 한 프로세스만 점검한다. INVENTORY_AUTOFILL=0이면 현황 조회만 한다.
+INVENTORY_WATERMARK_FACTOR = int(os.environ.get('INVENTORY_WATERMARK_FACTOR', 2))
+INVENTORY_WATERMARKS = json.loads(os.environ.get('INVENTORY_WATERMARKS', '{}')) # 예: {"14-16/essay": 5}
+INVENTORY_CHECK_INTERVAL = float(os.environ.get('INVENTORY_CHECK_INTERVAL', 300))
+INVENTORY_REFILL_BUDGET = int(os.environ.get('INVENTORY_REFILL_BUDGET', 6))
+INVENTORY_REFILL_BATCH = int(os.environ.get('INVENTORY_REFILL_BATCH', 3))
+INVENTORY_REFILL_DIFFICULTY = os.environ.get('INVENTORY_REFILL_DIFFICULTY', '표준')
+INVENTORY_AUTOFILL = os.environ.get('INVENTORY_AUTOFILL', '1') == '1'
+
+class InventoryManager:
+    def __init__(self, watermark_factor, watermarks):
+        self.watermark_factor = watermark_factor
+        self.watermarks = watermarks
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self.stats = {'checks': 0, 'refills_scheduled': 0, 'refills_skipped_budget': 0, 'last_check_at': None}
+
+    def watermark(self, age_group, category):
+        return int(self.watermarks.get(f"{age_group}/{category}", TEST_STRUCTURE.get(category, 0) * self.watermark_factor))
+
+    def _depths(self):
+        # (연령대, 유형)별 문항 수와, 참고용 난이도별 문항 수
+        by_difficulty = question_index.depths()
+        depths = {}
+        for (age_group, category, _), count in by_difficulty.items():
+            depths[(age_group, category)] = depths.get((age_group, category), 0) + count
+        return depths, by_difficulty
+
+    def _pending_refills(self):
+        rows = local_sqlite().execute("SELECT payload FROM jobs WHERE kind = 'refill' AND status IN ('queued', 'running')").fetchall()
+        return {(p['ageGroup'], p['category']) for p in (json.loads(r['payload']) for r in rows)}
+
+    def _budget_remaining(self):
+        used = local_sqlite().execute("SELECT COUNT(*) FROM jobs WHERE kind = 'refill' AND created_at >= ?", (time.time() - 3600,)).fetchone()[0]
+        return max(0, INVENTORY_REFILL_BUDGET - used)
+
+    def health(self):
+        depths, by_difficulty = self._depths()
+        pending = self._pending_refills()
+        buckets = []
+        for age_group in AGE_GROUPS:
+            for category in TEST_STRUCTURE:
+                depth, watermark = depths.get((age_group, category), 0), self.watermark(age_group, category)
+                buckets.append({'targetAge': age_group, 'category': category, 'depth': depth, 'lowWatermark': watermark,
+                                'byDifficulty': {d: by_difficulty.get((age_group, category, d), 0) for d in DIFFICULTIES},
+                                'status': 'empty' if depth == 0 else 'low' if depth < watermark else 'ok',
+                                'refillPending': (age_group, category) in pending})
+        test_ready = {age_group: all(depths.get((age_group, c), 0) >= n for c, n in TEST_STRUCTURE.items()) for age_group in AGE_GROUPS}
+        return {'buckets': buckets, 'testReady': test_ready, 'autofill': INVENTORY_AUTOFILL, 'refillBudgetRemaining': self._budget_remaining(), **self.stats}
+
+    def check(self):
+        self.stats['checks'] += 1
+        self.stats['last_check_at'] = time.time()
+        depths, _ = self._depths()
+        pending = self._pending_refills()
+        budget = self._budget_remaining()
+        # 시험지 한 장도 못 채우는 버킷, 그다음 하한선에서 많이 모자란 버킷 순으로 채운다.
+        low = sorted((depths.get(key, 0) >= TEST_STRUCTURE[key[1]], depths.get(key, 0) - self.watermark(*key), key)
+                     for key in ((a, c) for a in AGE_GROUPS for c in TEST_STRUCTURE))
+        for _, deficit, (age_group, category) in low:
+            if deficit >= 0 or (age_group, category) in pending: continue
+            if budget <= 0:
+                self.stats['refills_skipped_budget'] += 1
+                continue
+            job_queue.enqueue('refill', {'ageGroup': age_group, 'category': category, 'difficulty': INVENTORY_REFILL_DIFFICULTY, 'count': min(-deficit, INVENTORY_REFILL_BATCH)})
+            self.stats['refills_scheduled'] += 1
+            budget -= 1
+            app.logger.info(f"문제 재고 부족: {age_group}/{category} ({depths.get((age_group, category), 0)}개), 보충 작업 등록")
+
+    def _check_loop(self):
+        with open(JOB_DB_PATH + '.inventory.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            while True:
+                try:
+                    if db: self.check()
+                except Exception:
+                    app.logger.error("문제 재고 점검 오류", exc_info=True)
+                time.sleep(INVENTORY_CHECK_INTERVAL)
+
+    def start(self):
+        if not INVENTORY_AUTOFILL or self._started_pid == os.getpid(): return
+        with self._start_lock:
+            if self._started_pid == os.getpid(): return
+            threading.Thread(target=self._check_loop, name="inventory-check", daemon=True).start()
+            self._started_pid = os.getpid()
+
+inventory = InventoryManager(INVENTORY_WATERMARK_FACTOR, INVENTORY_WATERMARKS)
+
+@job_queue.handler('refill')
+def run_refill_job(job):
+    if not db: raise RuntimeError("DB 연결 실패")
+    payload, progress = job['payload'], job['progress']
+    created = progress.get('created', 0)
+    generated, saved = [], set()
+    try:
+        for _ in range(created, payload['count']):
+            generated.append(generate_question(payload['category'], payload['ageGroup'], None, payload['difficulty']))
+            job_queue.set_progress(job['id'], {'created': created, 'generated': len(generated)})
+
+        # 생성된 문제는 한 번에 저장하고, 문제 은행 캐시도 한 번만 무효화한다.
+        refs = [db.collection('questions').document() for _ in generated]
+        succeeded, failed = bulk_write([('create', ref, question_data) for ref, (question_data, _) in zip(refs, generated)])
+        for i, (ref, (question_data, candidate_id)) in enumerate(zip(refs, generated)):
+            if ref.id not in succeeded: continue
+            ai_cache.mark_served(candidate_id)
+            passage_index.commit(ref.id, question_data)
+            saved.add(i)
+    finally:
+        _release_unsaved(item for i, item in enumerate(generated) if i not in saved)
+    if succeeded: question_index.invalidate()
+    created += len(succeeded)
+    job_queue.set_progress(job['id'], {'created': created})
+    # 저장하지 못한 만큼은 작업 재시도 때 다시 만든다.
+    if failed: raise RuntimeError(f"보충 문제 저장 실패 {len(failed)}건: {failed[0]['error']}")
+    return {'created': created}
+
+# --- 9. Firestore 일괄 쓰기 ---
+# 여러 문서 쓰기를 BulkWriter로 묶어 보내고, 문서별 성공/실패를 돌려준다.
+BULK_RETRYABLE_CODES = {4, 8, 10, 13, 14} # DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, ABORTED, INTERNAL, UNAVAILABLE
+BULK_MAX_ATTEMPTS = int(os.environ.get('BULK_MAX_ATTEMPTS', 5))
+MINT_MAX_CODES = 400
+
+def bulk_write(operations):
+    # operations: [(작업, DocumentReference, 데이터)] 목록. 작업은 'create', 'set', 'update', 'delete' 중 하나.
+    lock = threading.Lock()
+    succeeded, failed = [], {}
+
+    def on_result(reference, result, writer):
+        with lock: succeeded.append(reference.id)
+
+    def on_error(failure, writer):
+        if failure.code in BULK_RETRYABLE_CODES and failure.attempts < BULK_MAX_ATTEMPTS: return True
+        with lock: failed[failure.operation.reference.id] = failure.message
+        return False
+
+    writer = db.bulk_writer()
+    writer.on_write_result(on_result)
+    writer.on_write_error(on_error)
+    for op, reference, data in operations:
+        if op == 'delete': writer.delete(reference)
+        else: getattr(writer, op)(reference, data)
+    writer.close()
+    return succeeded, [{"id": doc_id, "error": message} for doc_id, message in failed.items()]
+
+def _new_code():
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+
+@firestore.transactional
+def _mint_codes_in_transaction(transaction, refs, count, batch_id):
+    # 트랜잭션 안에서 후보 코드를 한 번에 읽고, 아직 없는 코드만 생성한다.
+    existing = {snap.id for snap in db.get_all(refs, transaction=transaction) if snap.exists}
+    created = []
+    now = datetime.now(timezone.utc)
+    for ref in refs:
+        if len(created) == count: break
+        if ref.id in existing: continue
+        transaction.create(ref, {'createdAt': now, 'isUsed': False, 'userName': None, 'batchId': batch_id})
+        created.append(ref.id)
+    return created
+
+def mint_access_codes(count, batch_id=None):
+    batch_id = batch_id or uuid.uuid4().hex[:8]
+    codes = []
+    for _ in range(3):
+        # 충돌을 대비해 여유분을 두고 후보를 뽑는다.
+        candidates = set()
+        while len(candidates) < (count - len(codes)) + 5: candidates.add(_new_code())
+        refs = [db.collection('access_codes').document(code) for code in candidates]
+        codes.extend(_mint_codes_in_transaction(db.transaction(), refs, count - len(codes), batch_id))
+        if len(codes) == count: break
+    return codes, batch_id
+
+# --- 10. AI 응답 캐시 ---
+# 검증을 통과한 AI 출력을 (정규화한 프롬프트, 모델) 해시로 로컬 SQLite에 보관한다.
+# 기본(unserved) 모드에서는 아직 문제 은행에 저장되지 않은 후보만 다시 쓴다. 생성 후 저장 전에 작업이 실패하거나
+# 프로세스가 죽어도, 같은 프롬프트로 재시도하면 AI를 다시 부르지 않는다. 이미 저장된 후보를 다시 쓰면 문제 은행에
+# 똑같은 문제가 들어가므로, 저장된(served) 후보는 어느 모드에서도 꺼내지 않는다.
+AI_CACHE_MODE = os.environ.get('AI_CACHE_MODE', 'unserved') # unserved | off
+AI_CACHE_TTL = int(os.environ.get('AI_CACHE_TTL', 7 * 24 * 3600))
+AI_CACHE_MAX_ENTRIES = int(os.environ.get('AI_CACHE_MAX_ENTRIES', 2000))
+AI_CACHE_LEASE_SECONDS = int(os.environ.get('AI_CACHE_LEASE_SECONDS', 600))
+# 절약 비용 추정용 단가 (USD / 1K 토큰)
+AI_COST_PER_1K_INPUT = float(os.environ.get('AI_COST_PER_1K_INPUT', 0.00125))
+AI_COST_PER_1K_OUTPUT = float(os.environ.get('AI_COST_PER_1K_OUTPUT', 0.01))
+
+class AICache:
+    def __init__(self, mode, ttl, max_entries):
+        self.mode = mode
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'saved_prompt_tokens': 0, 'saved_output_tokens': 0}
+        conn = local_sqlite()
+        conn.execute("""CREATE TABLE IF NOT EXISTS ai_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, model TEXT NOT NULL, response TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL, served INTEGER NOT NULL DEFAULT 0,
+            leased_until REAL NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS ai_cache_key_idx ON ai_cache (key, served)")
+
+    @staticmethod
+    def _key(prompt, model_name):
+        normalized = re.sub(r'\s+', ' ', prompt).strip()
+        return hashlib.sha256(f"{model_name}\n{normalized}".encode()).hexdigest()
+
+    def take(self, prompt, model_name):
+        # 후보를 찾으면 (응답, 후보 id)를 돌려주고, 다른 작업이 같은 후보를 가져가지 않도록 임대한다.
+        if self.mode == 'off': return None
+        now = time.time()
+        conn = local_sqlite()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM ai_cache WHERE key = ? AND served = 0 AND created_at >= ? AND leased_until < ? ORDER BY id LIMIT 1",
+                (self._key(prompt, model_name), now - self.ttl, now)).fetchone()
+            if row:
+                conn.execute("UPDATE ai_cache SET leased_until = ?, last_access = ? WHERE id = ?", (now + AI_CACHE_LEASE_SECONDS, now, row['id']))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if not row:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        self.stats['saved_prompt_tokens'] += row['prompt_tokens']
+        self.stats['saved_output_tokens'] += row['output_tokens']
+        return json.loads(row['response']), row['id']
+
+    def put(self, prompt, model_name, response, usage):
+        if self.mode == 'off': return None
+        now = time.time()
+        cursor = local_sqlite().execute(
+            "INSERT INTO ai_cache (key, model, response, prompt_tokens, output_tokens, leased_until, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (self._key(prompt, model_name), model_name, json.dumps(response, ensure_ascii=False),
+             usage.get('promptTokenCount', 0), usage.get('candidatesTokenCount', 0), now + AI_CACHE_LEASE_SECONDS, now, now))
+        self.stats['stores'] += 1
+        self._evict()
+        return cursor.lastrowid
+
+    def mark_served(self, candidate_id):
+        if candidate_id is None: return
+        local_sqlite().execute("UPDATE ai_cache SET served = 1, leased_until = 0 WHERE id = ?", (candidate_id,))
+
+    def release(self, candidate_id):
+        # 저장하지 못한 후보의 임대를 풀어, 작업을 재시도하면 AI를 다시 부르지 않고 바로 꺼내 쓰게 한다.
+        if candidate_id is None: return
+        local_sqlite().execute("UPDATE ai_cache SET leased_until = 0 WHERE id = ? AND served = 0", (candidate_id,))
+
+    def _evict(self):
+        conn = local_sqlite()
+        expired = conn.execute("DELETE FROM ai_cache WHERE created_at < ?", (time.time() - self.ttl,)).rowcount
+        # 가장 오래 쓰이지 않은 항목부터 지운다(LRU).
+        overflow = conn.execute(
+            "DELETE FROM ai_cache WHERE id IN (SELECT id FROM ai_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)", (self.max_entries,)).rowcount
+        self.stats['evictions'] += expired + overflow
+
+    def snapshot_stats(self):
+        total = self.stats['hits'] + self.stats['misses']
+        row = local_sqlite().execute("SELECT COUNT(*) AS entries, COALESCE(SUM(served = 0), 0) AS unserved FROM ai_cache").fetchone()
+        saved_cost = self.stats['saved_prompt_tokens'] / 1000 * AI_COST_PER_1K_INPUT + self.stats['saved_output_tokens'] / 1000 * AI_COST_PER_1K_OUTPUT
+        return {**self.stats, 'mode': self.mode, 'hit_ratio': self.stats['hits'] / total if total else 0,
+                'saved_cost_usd': round(saved_cost, 4), 'entries': row['entries'], 'unserved_entries': row['unserved']}
+
+ai_cache = AICache(AI_CACHE_MODE, AI_CACHE_TTL, AI_CACHE_MAX_ENTRIES)
+
+# --- 11. 라우팅 (API 엔드포인트) ---
 @app.route('/')
 def serve_index(): return render_template('index.html')
 
@@ -174,35 +1093,97 @@ def serve_index(): return render_template('index.html')
 def serve_admin(): return render_template('admin.html')
 
 # --- 관리자 페이지 API ---
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 200
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+INVALID_CURSOR_MESSAGE = "cursor가 올바르지 않습니다. 이전 응답의 nextCursor를 그대로 보내 주세요."
+
+def _page_params(cursor_size):
+    # 잘못된 limit/cursor는 ValueError로 알린다. 라우트가 400으로 돌려준다.
+    try:
+        limit = min(max(int(request.args.get('limit', PAGE_SIZE_DEFAULT)), 1), PAGE_SIZE_MAX)
+    except ValueError:
+        raise ValueError("limit은 정수여야 합니다.")
+    cursor = request.args.get('cursor')
+    if not cursor: return limit, None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != cursor_size or not all(isinstance(v, str) for v in values):
+        raise ValueError(INVALID_CURSOR_MESSAGE)
+    return limit, values
+
+def _count(query):
+    # 문서를 읽지 않고 집계 쿼리로 개수만 센다.
+    return query.count().get()[0][0].value
+
 @app.route('/api/generate-code', methods=['POST'])
 def generate_code():
     if not db: return jsonify({"success": False, "message": "DB 연결 실패"}), 500
     try:
-        code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-        code_ref = db.collection('access_codes').document(code)
-        if code_ref.get().exists: return generate_code()
-        code_ref.set({'createdAt': datetime.now(timezone.utc), 'isUsed': False, 'userName': None})
-        return jsonify({"success": True, "code": code})
+        codes, _ = mint_access_codes(1)
+        return jsonify({"success": True, "code": codes[0]})
+    except Exception as e:
+        return jsonify({"success": False, "message": f"서버 오류: {e}"}), 500
+
+@app.route('/api/generate-codes', methods=['POST'])
+def generate_codes():
+    if not db: return jsonify({"success": False, "message": "DB 연결 실패"}), 500
+    data = request.get_json() or {}
+    try:
+        count = int(data.get('count', 0))
+    except (TypeError, ValueError):
+        count = 0
+    if not 1 <= count <= MINT_MAX_CODES:
+        return jsonify({"success": False, "message": f"count는 1~{MINT_MAX_CODES} 사이여야 합니다."}), 400
+    try:
+        codes, batch_id = mint_access_codes(count, data.get('batchId'))
+        app.logger.info(f"접근 코드 {len(codes)}개 일괄 생성 (batch {batch_id})")
+        return jsonify({"success": len(codes) == count, "codes": codes, "batchId": batch_id, "requested": count,
+                        "message": f"{len(codes)}개 코드를 생성했습니다."})
     except Exception as e:
+        app.logger.error(f"접근 코드 일괄 생성 오류: {e}", exc_info=True)
         return jsonify({"success": False, "message": f"서버 오류: {e}"}), 500
 
 @app.route('/api/get-codes', methods=['GET'])
 def get_codes():
-    if not db: return jsonify([]), 500
+    # 생성일 역순 커서 기반 페이지. 생성일은 UTC ISO 문자열로 보내고 화면에서 KST로 표시한다.
+    if not db: return jsonify({"success": False, "message": "DB 연결 실패"}), 500
+    try:
+        limit, cursor = _page_params(2)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
     try:
-        codes_ref = db.collection('access_codes').order_by('createdAt', direction=firestore.Query.DESCENDING).stream()
+        cursor_created_at = datetime.fromisoformat(cursor[0]) if cursor else None
+    except ValueError:
+        return jsonify({"success": False, "message": INVALID_CURSOR_MESSAGE}), 400
+    try:
+        query = db.collection('access_codes')
+        if request.args.get('isUsed') in ('true', 'false'):
+            query = query.where(filter=FieldFilter('isUsed', '==', request.args['isUsed'] == 'true'))
+        page_query = query.order_by('createdAt', direction=firestore.Query.DESCENDING).order_by('__name__', direction=firestore.Query.DESCENDING).limit(limit)
+        if cursor:
+            page_query = page_query.start_after({'createdAt': cursor_created_at, '__name__': db.collection('access_codes').document(cursor[1])})
+
         codes = []
-        for doc in codes_ref:
+        for doc in page_query.stream():
             c = doc.to_dict()
-            dt_object = c['createdAt']
-            kst = timezone(timedelta(hours=9))
-            c['createdAt'] = dt_object.astimezone(kst).strftime('%Y-%m-%d %H:%M:%S')
+            c['createdAt'] = c['createdAt'].isoformat()
             c['code'] = doc.id
             codes.append(c)
-        return jsonify(codes)
+
+        response = {"success": True, "items": codes, "nextCursor": _encode_cursor([codes[-1]['createdAt'], codes[-1]['code']]) if len(codes) == limit else None}
+        if not cursor:
+            codes_ref = db.collection('access_codes')
+            response['summary'] = {"total": _count(codes_ref), "used": _count(codes_ref.where(filter=FieldFilter('isUsed', '==', True)))}
+        return jsonify(response)
     except Exception as e:
         app.logger.error(f"코드 조회 오류: {e}", exc_info=True)
-        return jsonify([]), 500
+        return jsonify({"success": False, "message": "코드 조회 중 오류가 발생했습니다."}), 500
 
 @app.route('/api/generate-question-set', methods=['POST'])
 def generate_question_set():
@@ -215,44 +1196,45 @@ def generate_question_set():
     difficulty = data.get('difficulty')
     text_content = data.get('textContent', None)
     
-    categories_to_generate = ["title", "theme", "argument", "inference", "pronoun", "sentence_ordering", "paragraph_ordering"]
-    
-    results = []
-    for category in categories_to_generate:
-        try:
-            app.logger.info(f"일괄 생성 중: Category: {category}, Age: {age_group}, Difficulty: {difficulty}")
-            prompt = get_detailed_prompt(category, age_group, text_content, difficulty)
-            question_data = call_ai_for_json(prompt)
-            question_data['difficulty'] = difficulty # 난이도 정보 추가
-
-            required_keys = ['passage', 'question']
-            if question_data.get('type') == 'multiple_choice':
-                required_keys.extend(['options', 'answer'])
-            if not all(key in question_data for key in required_keys):
-                 raise ValueError("AI 생성 데이터에 필수 키 누락")
-
-            db.collection('questions').add(question_data)
-            results.append({"category": CATEGORY_MAP.get(category), "status": "성공"})
-        except Exception as e:
-            app.logger.error(f"'{category}' 유형 생성 실패: {e}")
-            results.append({"category": CATEGORY_MAP.get(category), "status": "실패", "reason": str(e)})
+    progress = {c: {"category": CATEGORY_MAP.get(c), "status": "대기"} for c in QUESTION_SET_CATEGORIES}
+    job_id = job_queue.enqueue('question_set', {"ageGroup": age_group, "difficulty": difficulty, "textContent": text_content}, progress)
+    return jsonify({"success": True, "message": "문제 일괄 생성 작업이 등록되었습니다.", "jobId": job_id}), 202
 
-    return jsonify({"success": True, "message": "문제 일괄 생성이 완료되었습니다.", "results": results})
+QUESTION_LIST_FIELDS = ['category', 'targetAge', 'difficulty', 'type', 'question']
 
 @app.route('/api/get-questions', methods=['GET'])
 def get_questions():
-    if not db: return jsonify([]), 500
+    # 문서 id 순 커서 기반 페이지. 목록 화면에 필요한 필드만 읽고(fields=all이면 전체), 유형/연령/난이도는 서버에서 거른다.
+    if not db: return jsonify({"success": False, "message": "DB 연결 실패"}), 500
+    try:
+        limit, cursor = _page_params(1)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
     try:
-        questions_ref = db.collection('questions').stream()
+        query = db.collection('questions')
+        for field in ('category', 'targetAge', 'difficulty'):
+            if request.args.get(field):
+                query = query.where(filter=FieldFilter(field, '==', request.args[field]))
+        page_query = query.order_by('__name__').limit(limit)
+        fields = request.args.get('fields')
+        if fields != 'all':
+            page_query = page_query.select(fields.split(',') if fields else QUESTION_LIST_FIELDS)
+        if cursor:
+            page_query = page_query.start_after({'__name__': db.collection('questions').document(cursor[0])})
+
         questions = []
-        for doc in questions_ref:
+        for doc in page_query.stream():
             q = doc.to_dict()
             q['id'] = doc.id
             questions.append(q)
-        return jsonify(questions)
+
+        response = {"success": True, "items": questions, "nextCursor": _encode_cursor([questions[-1]['id']]) if len(questions) == limit else None}
+        if not cursor:
+            response['total'] = _count(query)
+        return jsonify(response)
     except Exception as e:
         app.logger.error(f"문제 목록 조회 오류: {e}", exc_info=True)
-        return jsonify([]), 500
+        return jsonify({"success": False, "message": "문제 목록 조회 중 오류가 발생했습니다."}), 500
 
 @app.route('/api/delete-questions', methods=['POST'])
 def delete_questions():
@@ -263,10 +1245,12 @@ def delete_questions():
         return jsonify({"success": False, "message": "삭제할 ID 목록이 없습니다."}), 400
     
     try:
-        for q_id in ids_to_delete:
-            db.collection('questions').document(q_id).delete()
-        app.logger.info(f"{len(ids_to_delete)}개 문제 삭제 성공.")
-        return jsonify({"success": True, "message": f"{len(ids_to_delete)}개 문제를 삭제했습니다."})
+        deleted, failed = bulk_write([('delete', db.collection('questions').document(q_id), None) for q_id in ids_to_delete])
+        passage_index.remove(deleted)
+        question_index.invalidate()
+        app.logger.info(f"{len(deleted)}개 문제 삭제 성공, {len(failed)}개 실패.")
+        message = f"{len(deleted)}개 문제를 삭제했습니다." + (f" ({len(failed)}개 실패)" if failed else "")
+        return jsonify({"success": not failed, "message": message, "deleted": deleted, "failed": failed})
     except Exception as e:
         app.logger.error(f"문제 삭제 중 오류 발생: {e}", exc_info=True)
         return jsonify({"success": False, "message": "문제 삭제 중 오류가 발생했습니다."}), 500
@@ -279,28 +1263,42 @@ def regenerate_question():
     if not question_id:
         return jsonify({"success": False, "message": "ID가 필요합니다."}), 400
     
-    try:
-        doc_ref = db.collection('questions').document(question_id)
-        old_doc = doc_ref.get()
-        if not old_doc.exists:
-            return jsonify({"success": False, "message": "문서를 찾을 수 없습니다."}), 404
-        
-        old_data = old_doc.to_dict()
-        category = old_data.get('category')
-        age_group = old_data.get('targetAge')
-        difficulty = old_data.get('difficulty', '표준') # 기존 난이도 유지
+    job_id = job_queue.enqueue('regenerate_question', {"id": question_id})
+    return jsonify({"success": True, "message": "문제 재생성 작업이 등록되었습니다.", "jobId": job_id}), 202
 
-        prompt = get_detailed_prompt(category, age_group, None, difficulty)
-        new_question_data = call_ai_for_json(prompt)
-        new_question_data['difficulty'] = difficulty
-
-        doc_ref.update(new_question_data)
-        app.logger.info(f"문제 재성공 성공: ID {question_id}")
-        return jsonify({"success": True, "message": "문제를 성공적으로 다시 생성했습니다."})
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if not job: return jsonify({"success": False, "message": "작업을 찾을 수 없습니다."}), 404
+    job.pop('payload')
+    return jsonify({"success": True, "job": job})
 
+@app.route('/api/inventory', methods=['GET'])
+def get_inventory():
+    if not db: return jsonify({"success": False, "message": "DB 연결 실패"}), 500
+    try:
+        return jsonify({"success": True, **inventory.health()})
     except Exception as e:
-        app.logger.error(f"문제 재성성 중 오류: {e}", exc_info=True)
-        return jsonify({"success": False, "message": "문제 재성성 중 오류가 발생했습니다."})
+        app.logger.error(f"문제 재고 조회 오류: {e}", exc_info=True)
+        return jsonify({"success": False, "message": "문제 재고 조회 중 오류가 발생했습니다."}), 500
+
+@app.route('/api/ready', methods=['GET'])
+def readiness():
+    # 의존성별 준비 상태. 시험지를 낼 수 있는지만 준비 여부(HTTP 상태)에 반영하고, Sheets/Gemini는 상태만 알린다.
+    # 로컬 문제 은행으로 시험지를 낼 수 있으면 Firestore 장애 중에도 준비된 것으로 본다(local-only에서는 로컬 문제 은행만 본다).
+    services = {"firestore": db.status(), "sheets": sheet.status(), "gemini": {**gemini.status(), "configured": bool(GEMINI_API_KEY)},
+                "localQuestionBank": {"ready": local_bank.stats['questions'] > 0, "questions": local_bank.stats['questions'], "mode": QUESTION_BANK_MODE}}
+    questions_loaded = question_index.snapshot_stats()['age_seconds'] is not None
+    firestore_ready = QUESTION_BANK_MODE != 'local-only' and services['firestore']['ready'] and questions_loaded
+    ready = firestore_ready or services['localQuestionBank']['ready']
+    process = {"pid": os.getpid(), "uptimeSeconds": time.time() - PROCESS_STARTED_AT, "importSeconds": IMPORT_SECONDS,
+               "warmUpSeconds": _warm_up['seconds'], "warmUpErrors": _warm_up['errors'], "questionIndexLoaded": questions_loaded}
+    return jsonify({"ready": ready, "process": process, "services": services}), 200 if ready else 503
+
+@app.route('/api/system-stats', methods=['GET'])
+def system_stats():
+    return jsonify({"questionCache": question_index.snapshot_stats(), "sheetExporter": sheet_exporter.snapshot_stats(), "gemini": gemini.snapshot_stats(), "aiCache": ai_cache.snapshot_stats(),
+                    "passageIndex": passage_index.snapshot_stats(), "localQuestionBank": local_bank.snapshot_stats()})
 
 # --- 사용자 페이지 API ---
 @app.route('/api/validate-code', methods=['POST'])
@@ -315,28 +1313,13 @@ def validate_code():
 
 @app.route('/api/get-test', methods=['POST'])
 def get_test():
-    if not db: return jsonify([]), 500
     try:
         data = request.get_json()
-        age = int(data.get('age', 0))
-        age_group = "10-13"
-        if 14 <= age <= 16: age_group = "14-16"
-        elif 17 <= age <= 19: age_group = "17-19"
+        age_group = age_group_for(data.get('age', 0))
 
-        test_structure = { "title": 2, "theme": 2, "argument": 2, "inference": 2, "pronoun": 2, "sentence_ordering": 2, "paragraph_ordering": 2, "essay": 1 }
-        questions = []
-        for category, needed_count in test_structure.items():
-            query = db.collection('questions').where(filter=FieldFilter('targetAge', '==', age_group)).where(filter=FieldFilter('category', '==', category))
-            docs = query.stream()
-            potential_questions = []
-            for doc in docs:
-                q = doc.to_dict()
-                q['id'] = doc.id
-                potential_questions.append(q)
-            
-            num_to_select = min(needed_count, len(potential_questions))
-            if num_to_select > 0:
-                questions.extend(random.sample(potential_questions, num_to_select))
+        # Firestore가 죽었거나 느려도 로컬 문제 은행으로 시험지를 만든다(16. 로컬 문제 은행).
+        questions = sample_test_questions(age_group, TEST_STRUCTURE)
+        if not questions: return jsonify([]), 500
         
         question_number = 1
         for q in questions:
@@ -351,9 +1334,67 @@ def get_test():
         app.logger.error(f"'/api/get-test' 오류: {e}", exc_info=True)
         return jsonify([]), 500
 
+@app.route('/api/report-status/<report_id>', methods=['GET'])
+def report_status(report_id):
+    job = job_queue.get(report_id)
+    if not job or job['kind'] != 'report': return jsonify({"success": False, "message": "보고서를 찾을 수 없습니다."}), 404
+    report_text = job['progress'].get('reportText')
+    return jsonify({"success": True, "ready": report_text is not None, "overall_comment": report_text})
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/report-stream/<report_id>', methods=['GET'])
+def report_stream(report_id):
+    # 점수/메타인지를 먼저 보내고, AI 보고서를 토큰 단위로 server-sent events로 흘려보낸다.
+    # 다 받은 글은 작업 진행 상황에 기록하고 작업을 깨워, reports 저장과 시트 기록이 곧바로 이어지게 한다.
+    job = job_queue.get(report_id)
+    if not job or job['kind'] != 'report': return jsonify({"success": False, "message": "보고서를 찾을 수 없습니다."}), 404
+    payload = job['payload']
+
+    def events():
+        yield _sse('scores', {"analysis": payload['scores'], "metacognition": payload['metacognition'], "recommendations": payload['recommendations']})
+        # 스트림 자리가 없거나, 이미 끝났거나 백그라운드 작업이 쓰고 있으면 스레드를 붙잡고 기다리지 않고 폴링으로 넘긴다.
+        if not _report_stream_slots.acquire(blocking=False):
+            metrics.inc('report_stream_rejected_total')
+            job_queue.wake(report_id)
+            yield _sse('poll', {"message": "보고서가 완성되면 표시됩니다."})
+            return
+        try:
+            if job_queue.update_progress(report_id, _claim_report_step('narrative', 'streaming')) is None:
+                report_text = job_queue.get(report_id)['progress'].get('reportText')
+                if report_text is not None: yield _sse('done', {"overall_comment": report_text})
+                else: yield _sse('poll', {"message": "보고서가 완성되면 표시됩니다."})
+                return
+            yield from _stream_report_narrative(report_id, payload)
+        finally:
+            _report_stream_slots.release()
+
+    return app.response_class(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def _stream_report_narrative(report_id, payload):
+    chunks, finished = [], False
+    try:
+        prompt = build_report_prompt(payload['userInfo'].get('name'), payload['scores'], payload['metacognition'], len(payload['results']), payload['correctCount'])
+        for chunk in gemini.stream(prompt, "gemini-2.5-pro"):
+            chunks.append(chunk)
+            yield _sse('token', {"text": chunk})
+        finished = True
+    except Exception as e:
+        app.logger.error(f"AI 보고서 스트리밍 실패 ({report_id}): {e}", exc_info=True)
+        yield _sse('error', {"message": "AI 보고서 스트리밍에 실패했습니다. 잠시 후 결과가 표시됩니다."})
+    finally:
+        if finished:
+            report_text = ''.join(chunks)
+            job_queue.update_progress(report_id, _finish_report_step('narrative', {'reportText': report_text}))
+        else:
+            # 스트림이 끊기면 백그라운드 작업이 보고서 작성을 다시 맡는다.
+            job_queue.update_progress(report_id, lambda p: p['steps']['narrative'].update(status='pending') if p['steps']['narrative']['status'] == 'streaming' else False)
+        job_queue.wake(report_id)
+    if finished: yield _sse('done', {"overall_comment": report_text})
+
 @app.route('/api/submit-result', methods=['POST'])
 def submit_result():
-    if not db or not sheet: return jsonify({"success": False, "message": "DB 또는 시트 연결 실패"}), 500
     data = request.get_json()
     user_info = data.get('userInfo', {})
     results = data.get('results', [])
@@ -366,7 +1407,7 @@ def submit_result():
         
         for r in results:
             score_category = SCORE_CATEGORY_MAP.get(r['question']['category'])
-            is_correct = (r['question'].get('type') != 'essay' and r['answer'] == r['question']['answer']) or (r['question'].get('type') == 'essay' and len(r.get('answer', '')) >= 50)
+            is_correct = is_correct_answer(r)
             if is_correct: correct_count += 1
             if score_category: scores[score_category].append(100 if is_correct else 0)
             confidence = r.get('confidence', 'unsure')
@@ -387,13 +1428,6 @@ def submit_result():
             'avg_time_ue': sum(metacognition_details['unsure_error']) / len(metacognition_details['unsure_error']) if metacognition_details['unsure_error'] else 0,
         }
 
-        final_report_text = "결과 분석 중..."
-        try:
-            final_report_text = generate_dynamic_report_from_ai(user_info.get('name'), final_scores, metacognition_summary, len(results), correct_count)
-        except Exception as ai_e:
-            app.logger.error(f"AI 동적 리포트 생성 실패: {ai_e}", exc_info=True)
-            final_report_text = "AI 리포트 생성에 실패했습니다. 기본 리포트를 표시합니다."
-
         recommendations = []
         sorted_scores = sorted([(score, cat) for cat, score in final_scores.items() if cat != "문제 풀이 속도"])
         if sorted_scores:
@@ -403,18 +1437,22 @@ def submit_result():
             elif weakest_category == "논리 분석력": recommendations.append({"skill": "논리 분석력 강화", "text": "글의 순서나 구조를 파악하는 연습을 해보세요. 짧은 뉴스 기사를 읽고 문단별로 핵심 내용을 요약하는 훈련이 도움이 될 것입니다."})
 
         timestamp = datetime.now(timezone(timedelta(hours=9))).strftime('%Y-%m-%d %H:%M:%S')
-        report_data = { "userInfo": user_info, "results": results, "scores": final_scores, "metacognition": metacognition_summary, "reportText": final_report_text, "recommendations": recommendations, "timestamp": timestamp }
-        db.collection('reports').add(report_data)
+        sheet_row = [ timestamp, user_info.get('name'), user_info.get('age'), access_code_of(user_info), final_scores.get('정보 이해력', 0), final_scores.get('논리 분석력', 0), final_scores.get('단서 추론력', 0), final_scores.get('비판적 사고력', 0), final_scores.get('창의적 서술력', 0), final_scores.get('문제 풀이 속도', 0), correct_count, len(results), total_time ]
 
-        sheet_row = [ timestamp, user_info.get('name'), user_info.get('age'), user_info.get('code'), final_scores.get('정보 이해력', 0), final_scores.get('논리 분석력', 0), final_scores.get('단서 추론력', 0), final_scores.get('비판적 사고력', 0), final_scores.get('창의적 서술력', 0), final_scores.get('문제 풀이 속도', 0), correct_count, len(results), total_time ]
-        sheet.append_row(sheet_row)
-        
-        return jsonify({ "success": True, "analysis": final_scores, "metacognition": metacognition_summary, "overall_comment": final_report_text, "recommendations": recommendations })
+        # AI 보고서 작성, reports 저장, 시트 기록은 백그라운드 작업으로 넘기고 점수는 바로 돌려준다.
+        report_payload = { "userInfo": user_info, "results": results, "scores": final_scores, "metacognition": metacognition_summary, "recommendations": recommendations, "timestamp": timestamp, "correctCount": correct_count, "sheetRow": sheet_row }
+        steps = {name: {"status": "pending", "attempts": 0, "error": None} for name, _, _ in REPORT_STEPS}
+        report_id = job_queue.enqueue('report', report_payload, {"steps": steps, "reportText": None}, delay=REPORT_STREAM_GRACE if data.get('stream') else 0)
+
+        return jsonify({ "success": True, "analysis": final_scores, "metacognition": metacognition_summary, "overall_comment": None, "recommendations": recommendations, "reportId": report_id })
     except Exception as e:
         app.logger.error(f"결과 처리 중 오류: {e}", exc_info=True)
         return jsonify({"success": False, "message": f"결과를 전송하는 중 오류가 발생했습니다: {e}"}), 500
 
 def generate_dynamic_report_from_ai(user_name, scores, metacognition, total_questions, correct_count):
+    return call_ai_for_text(build_report_prompt(user_name, scores, metacognition, total_questions, correct_count), model_name="gemini-2.5-pro")
+
+def build_report_prompt(user_name, scores, metacognition, total_questions, correct_count):
     strongest_score, strongest_category, weakest_score, weakest_category = 0, "없음", 100, "없음"
     for category, score in scores.items():
         if category != "문제 풀이 속도":
@@ -445,7 +1483,850 @@ def generate_dynamic_report_from_ai(user_name, scores, metacognition, total_ques
 4.  **결론: 성장을 위한 구체적인 코칭 가이드**: 분석 내용을 종합하여, 학생의 성장을 위한 1~2가지 핵심 조언을 제시합니다. **(독서 추천)** 학생의 '보완점'을 길러줄 수 있는 책의 종류(장르)를 추천하고, 왜 그 책이 도움이 되는지, 어느 정도 분량(예: 200페이지 내외)의 책부터 시작하면 좋을지 구체적으로 제안해주세요. 학생에게 동기를 부여할 수 있는 긍정적인 비전을 제시하며 마무리합니다.
 5.  **형식:** 전체 내용은 가독성을 위해 Markdown(#, ##, **)을 사용하여 명확하게 구조화해주세요.
 """
-    return call_ai_for_text(prompt, model_name="gemini-2.5-pro")
+    return prompt
+
+# --- 12. 지표와 추적 ---
+# 요청별 지연/상태 코드와 외부 호출(Firestore, Gemini, Sheets)별 지연/오류, Firestore 문서 읽기·쓰기 수, Gemini 토큰 사용량을
+# 프로세스 메모리에 모아 /metrics에서 Prometheus 텍스트 형식으로 내보낸다. 값은 워커 프로세스마다 따로 쌓인다.
+# 응답에는 Server-Timing 헤더로 외부 서비스별 소요 시간을 붙이고, TRACING_ENABLED=1이면 OpenTelemetry 스팬도 만든다.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 180)
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 5))
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING_ENABLED', '1') == '1'
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', '0') == '1'
+
+METRIC_HELP = {
+    'http_requests_total': "HTTP 요청 수",
+    'http_request_duration_seconds': "HTTP 요청 처리 시간 (응답 헤더까지)",
+    'dependency_call_duration_seconds': "외부 서비스 호출 시간",
+    'dependency_errors_total': "외부 서비스 호출 실패 수",
+    'firestore_document_reads_total': "Firestore에서 읽은 문서 수",
+    'firestore_document_writes_total': "Firestore에 쓴 문서 수",
+    'gemini_tokens_total': "Gemini 토큰 사용량",
+    'gemini_retries_total': "Gemini 호출 재시도 수",
+    'gemini_rejected_total': "circuit breaker로 거절한 Gemini 호출 수",
+    'report_stream_rejected_total': "동시 스트림 한도로 폴링으로 돌려보낸 보고서 스트림 수",
+    'test_questions_served_total': "시험지에 낸 문항 수 (출처별)",
+    'jobs': "상태별 백그라운드 작업 수",
+    'sheet_spool_depth': "Sheets 전송 대기 행 수",
+    'gemini_circuit_open': "Gemini circuit breaker 열림 여부",
+}
+
+def _format_labels(labels):
+    if not labels: return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            state = series.setdefault(key, [[0] * len(self.buckets), 0.0, 0]) # [구간별 건수, 합계, 전체 건수]
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), None)
+            if index is not None: state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self, gauges=()):
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: {k: (list(v[0]), v[1], v[2]) for k, v in series.items()} for name, series in self._histograms.items()}
+        lines = []
+        for name, series in sorted(counters.items()):
+            lines += [f"# HELP {name} {METRIC_HELP.get(name, name)}", f"# TYPE {name} counter"]
+            lines += [f"{name}{_format_labels(labels)} {value}" for labels, value in sorted(series.items())]
+        for name, series in sorted(histograms.items()):
+            lines += [f"# HELP {name} {METRIC_HELP.get(name, name)}", f"# TYPE {name} histogram"]
+            for labels, (counts, total, count) in sorted(series.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines += [f"{name}_sum{_format_labels(labels)} {total}", f"{name}_count{_format_labels(labels)} {count}"]
+        for name, series in gauges:
+            lines += [f"# HELP {name} {METRIC_HELP.get(name, name)}", f"# TYPE {name} gauge"]
+            lines += [f"{name}{_format_labels(tuple(sorted(labels.items())))} {value}" for labels, value in series]
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(METRICS_BUCKETS)
+
+_tracer = {'tracer': None, 'checked': False}
+
+def _get_tracer():
+    # OpenTelemetry는 선택 의존성이다. 내보내기(exporter) 설정은 배포 환경(opentelemetry-instrument 등)에 맡긴다.
+    if not TRACING_ENABLED: return None
+    if not _tracer['checked']:
+        _tracer['checked'] = True
+        try:
+            from opentelemetry import trace
+            _tracer['tracer'] = trace.get_tracer("reading-test")
+        except ImportError:
+            app.logger.warning("TRACING_ENABLED=1 이지만 opentelemetry-api가 설치되어 있지 않아 스팬을 만들지 않습니다.")
+    return _tracer['tracer']
+
+def record_dependency_call(dependency, operation, elapsed, error=None, **labels):
+    # 외부 호출 한 번을 지표, 현재 요청의 소요 시간 합계, (켜져 있으면) 스팬에 기록한다.
+    metrics.observe('dependency_call_duration_seconds', elapsed, dependency=dependency, operation=operation, **labels)
+    if error: metrics.inc('dependency_errors_total', dependency=dependency, operation=operation, error=error, **labels)
+    if has_request_context() and 'dependency_seconds' in g:
+        g.dependency_seconds[dependency] = g.dependency_seconds.get(dependency, 0) + elapsed
+        g.dependency_calls[dependency] = g.dependency_calls.get(dependency, 0) + 1
+    tracer = _get_tracer()
+    if tracer:
+        # 호출이 끝난 뒤 기록하므로 시작/종료 시각을 직접 넘긴다. 요청 스팬이 현재 컨텍스트면 그 아래에 붙는다.
+        end_ns = time.time_ns()
+        span = tracer.start_span(f"{dependency} {operation}", start_time=end_ns - int(elapsed * 1e9),
+                                 attributes={'dependency': dependency, 'operation': operation, **{k: str(v) for k, v in labels.items()}})
+        if error: span.set_attribute('error.type', error)
+        span.end(end_time=end_ns)
+
+FIRESTORE_OPERATIONS = {'get', 'stream', 'get_all', 'set', 'update', 'delete', 'create', 'add', 'close', 'commit'}
+FIRESTORE_CHAIN_METHODS = {'collection', 'document', 'where', 'order_by', 'limit', 'select', 'start_after', 'count', 'bulk_writer', 'transaction', 'batch'}
+FIRESTORE_READ_OPERATIONS = {'get', 'stream', 'get_all'}
+FIRESTORE_WRITE_OPERATIONS = {'set', 'update', 'delete', 'create', 'add'}
+SHEETS_OPERATIONS = {'append_rows', 'append_row'}
+
+def _unwrap(value):
+    if isinstance(value, InstrumentedClient): return value._target
+    if isinstance(value, dict): return {k: _unwrap(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)): return type(value)(_unwrap(v) for v in value)
+    return value
+
+class InstrumentedClient:
+    # 외부 클라이언트를 감싸 operations에 있는 메서드 호출마다 지연과 오류를 기록한다. Firestore는 읽고 쓴 문서 수도 센다.
+    # chain_methods(collection, where 등)가 돌려주는 참조/쿼리/트랜잭션도 다시 감싸고, 실제 클라이언트에 넘기는 인자는 풀어서 넘긴다.
+    def __init__(self, target, dependency, operations, chain_methods=(), collection=''):
+        self._target = target
+        self._dependency = dependency
+        self._operations = operations
+        self._chain_methods = chain_methods
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name in self._chain_methods:
+            def chain(*args, **kwargs):
+                collection = args[0] if name == 'collection' and args else self._collection
+                return InstrumentedClient(attr(*_unwrap(args), **_unwrap(kwargs)), self._dependency, self._operations, self._chain_methods, collection)
+            return chain
+        if name not in self._operations: return attr
+
+        def call(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = attr(*_unwrap(args), **_unwrap(kwargs))
+            except Exception as e:
+                self._record(name, time.perf_counter() - started, type(e).__name__)
+                raise
+            # stream/get_all은 제너레이터라 다 읽을 때까지의 시간과 문서 수를 센다.
+            if hasattr(result, '__next__'): return self._iterate(name, result, started)
+            reads = 0
+            if name in FIRESTORE_READ_OPERATIONS:
+                reads = sum(1 for item in result if hasattr(item, 'exists')) if isinstance(result, list) else 1
+            self._record(name, time.perf_counter() - started, reads=reads)
+            return result
+        return call
+
+    def _iterate(self, name, iterator, started):
+        reads, error = 0, None
+        try:
+            for item in iterator:
+                reads += 1
+                yield item
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self._record(name, time.perf_counter() - started, error, reads)
+
+    def _record(self, operation, elapsed, error=None, reads=0):
+        labels = {'collection': self._collection} if self._dependency == 'firestore' else {}
+        record_dependency_call(self._dependency, operation, elapsed, error, **labels)
+        if self._dependency != 'firestore': return
+        if reads: metrics.inc('firestore_document_reads_total', reads, operation=operation, **labels)
+        if operation in FIRESTORE_WRITE_OPERATIONS and not error: metrics.inc('firestore_document_writes_total', operation=operation, **labels)
+
+@app.before_request
+def _start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.dependency_seconds, g.dependency_calls = {}, {}
+    tracer = _get_tracer()
+    if tracer:
+        from opentelemetry import trace, context
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        g.request_span = tracer.start_span(f"{request.method} {endpoint}", kind=trace.SpanKind.SERVER,
+                                           attributes={'http.method': request.method, 'http.route': endpoint})
+        g.request_span_token = context.attach(trace.set_span_in_context(g.request_span))
+
+@app.after_request
+def _finish_request_metrics(response):
+    if 'request_started' not in g: return response
+    # SSE처럼 본문을 흘려보내는 응답은 헤더를 보내기까지의 시간만 잰다.
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('http_requests_total', method=request.method, endpoint=endpoint, status=response.status_code)
+    metrics.observe('http_request_duration_seconds', elapsed, method=request.method, endpoint=endpoint)
+    if SERVER_TIMING_ENABLED:
+        timings = [f"{dep};dur={seconds * 1000:.1f};desc=\"{g.dependency_calls[dep]} calls\"" for dep, seconds in g.dependency_seconds.items()]
+        response.headers['Server-Timing'] = ', '.join(timings + [f"app;dur={elapsed * 1000:.1f}"])
+    if elapsed >= SLOW_REQUEST_SECONDS:
+        breakdown = ', '.join(f"{dep} {seconds:.2f}초/{g.dependency_calls[dep]}회" for dep, seconds in g.dependency_seconds.items()) or '외부 호출 없음'
+        app.logger.warning(f"느린 요청: {request.method} {endpoint} {elapsed:.2f}초 ({breakdown})")
+    if 'request_span' in g: g.request_span.set_attribute('http.status_code', response.status_code)
+    return response
+
+@app.teardown_request
+def _end_request_span(exc):
+    if 'request_span' not in g: return
+    from opentelemetry import context
+    if exc is not None: g.request_span.record_exception(exc)
+    g.request_span.end()
+    context.detach(g.request_span_token)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    gauges = []
+    try:
+        rows = local_sqlite().execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        gauges.append(('jobs', [({'status': row['status']}, row['n']) for row in rows]))
+        gauges.append(('sheet_spool_depth', [({}, sheet_exporter._spool_state()[0])]))
+    except sqlite3.Error as e:
+        app.logger.error(f"지표 수집 중 로컬 상태 조회 실패: {e}")
+    client = gemini._client
+    if client: gauges.append(('gemini_circuit_open', [({}, int(bool(client._open_until) and time.time() < client._open_until))]))
+    return Response(metrics.render(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# --- 13. 코호트 분석 집계 ---
+# 보고서가 저장될 때 (일자, 연령대, 코드 배치)별 집계 문서(report_rollups)에 점수 합계, 제곱합, 구간별 인원을 Increment로 더한다.
+# 한 집계 문서에 쓰기가 몰리지 않도록 ANALYTICS_SHARDS개 문서로 나눠 쓰고, 조회할 때 합친다.
+# 이 기능 전에 저장된 보고서는 analytics_backfill 작업이 NumPy로 한 번에 계산해 'backfill' 문서로 저장한다.
+ANALYTICS_SHARDS = int(os.environ.get('ANALYTICS_SHARDS', 8))
+ANALYTICS_MAX_DAYS = int(os.environ.get('ANALYTICS_MAX_DAYS', 366))
+SCORE_BIN_WIDTH = 5
+SCORE_BINS = 100 // SCORE_BIN_WIDTH # 100점은 마지막 구간에 넣는다.
+ANALYTICS_SKILLS = {"정보 이해력": "comprehension", "논리 분석력": "logic", "단서 추론력": "inference", "비판적 사고력": "critical", "창의적 서술력": "creative", "문제 풀이 속도": "speed"}
+METACOGNITION_KEYS = ['confident_correct', 'confident_error', 'unsure_correct', 'unsure_error']
+ANALYTICS_GROUP_FIELDS = ['day', 'ageGroup', 'batchId']
+ANALYTICS_PERCENTILES = (10, 25, 50, 75, 90)
+
+def access_code_of(user_info):
+    # 화면은 accessCode로, 예전 요청은 code로 보낸다.
+    return (user_info.get('accessCode') or user_info.get('code') or '').upper() or None
+
+def analytics_dimensions(user_info, timestamp, batch_ids=None):
+    # timestamp는 KST 'YYYY-MM-DD HH:MM:SS' 문자열이다. batch_ids가 없으면 접근 코드 문서를 읽어 배치를 찾는다.
+    code = access_code_of(user_info)
+    if batch_ids is not None: batch_id = batch_ids.get(code)
+    else:
+        code_doc = db.collection('access_codes').document(code).get() if code else None
+        batch_id = code_doc.to_dict().get('batchId') if code_doc and code_doc.exists else None
+    return {'day': timestamp[:10], 'ageGroup': age_group_for(user_info.get('age')), 'batchId': batch_id}
+
+def _rollup_id(dimensions, shard):
+    return f"{dimensions['day']}_{dimensions['ageGroup']}_{dimensions['batchId'] or 'none'}_{shard}"
+
+def _score_bin(score):
+    return min(SCORE_BINS - 1, max(0, int(score // SCORE_BIN_WIDTH)))
+
+def add_report_to_rollup(batch, dimensions, scores, metacognition, correct_count, total_questions):
+    shard = random.randrange(ANALYTICS_SHARDS)
+    skills = {}
+    for name, key in ANALYTICS_SKILLS.items():
+        score = float(scores.get(name, 0))
+        skills[key] = {'sum': firestore.Increment(score), 'sumSq': firestore.Increment(score * score), 'hist': {str(_score_bin(score)): firestore.Increment(1)}}
+    batch.set(db.collection('report_rollups').document(_rollup_id(dimensions, shard)), {
+        **dimensions, 'shard': str(shard), 'count': firestore.Increment(1), 'correct': firestore.Increment(correct_count),
+        'questions': firestore.Increment(total_questions), 'skills': skills,
+        'metacognition': {k: firestore.Increment(metacognition.get(k, 0)) for k in METACOGNITION_KEYS}}, merge=True)
+
+def _merge_rollup(total, doc):
+    total['count'] += doc.get('count', 0)
+    total['correct'] += doc.get('correct', 0)
+    total['questions'] += doc.get('questions', 0)
+    for key in METACOGNITION_KEYS: total['metacognition'][key] += doc.get('metacognition', {}).get(key, 0)
+    for key in ANALYTICS_SKILLS.values():
+        skill, merged = doc.get('skills', {}).get(key, {}), total['skills'][key]
+        merged['sum'] += skill.get('sum', 0)
+        merged['sumSq'] += skill.get('sumSq', 0)
+        for b, n in skill.get('hist', {}).items(): merged['hist'][int(b)] += n
+
+def _empty_rollup():
+    return {'count': 0, 'correct': 0, 'questions': 0, 'metacognition': {k: 0 for k in METACOGNITION_KEYS},
+            'skills': {key: {'sum': 0.0, 'sumSq': 0.0, 'hist': [0] * SCORE_BINS} for key in ANALYTICS_SKILLS.values()}}
+
+def _histogram_percentile(hist, count, p):
+    # 구간 안에서는 고르게 퍼져 있다고 보고 선형 보간한다.
+    target, cumulative = count * p / 100, 0
+    for b, n in enumerate(hist):
+        if n and cumulative + n >= target: return round(b * SCORE_BIN_WIDTH + SCORE_BIN_WIDTH * (target - cumulative) / n, 1)
+        cumulative += n
+    return 100.0
+
+def _summarize_rollup(total):
+    n = total['count']
+    skills = {}
+    for name, key in ANALYTICS_SKILLS.items():
+        skill = total['skills'][key]
+        mean = skill['sum'] / n if n else 0
+        skills[name] = {"mean": round(mean, 1), "std": round(max(0.0, skill['sumSq'] / n - mean * mean) ** 0.5, 1) if n else 0,
+                        "percentiles": {f"p{p}": _histogram_percentile(skill['hist'], n, p) if n else None for p in ANALYTICS_PERCENTILES},
+                        "histogram": skill['hist']}
+    return {"count": n, "correctRate": round(total['correct'] / total['questions'], 3) if total['questions'] else None,
+            "metacognition": {k: round(v / n, 2) if n else 0 for k, v in total['metacognition'].items()}, "skills": skills}
+
+@job_queue.handler('analytics_backfill')
+def run_analytics_backfill_job(job):
+    # 집계가 도입되기 전에 저장된(analytics 필드가 없는) 보고서만 모아 그룹별로 한 번에 계산하고 'backfill' 샤드 문서를 덮어쓴다.
+    # 실시간 Increment 샤드와 문서가 달라 언제 다시 돌려도 중복 집계되지 않는다.
+    import numpy as np # 무거운 import라 백필 작업에서만 불러온다.
+    if not db: raise RuntimeError("DB 연결 실패")
+    fields = ['userInfo', 'scores', 'metacognition', 'timestamp', 'correctCount', 'totalQuestions', 'results', 'analytics']
+    rows, scanned = [], 0
+    for doc in db.collection('reports').select(fields).stream():
+        scanned += 1
+        report = doc.to_dict()
+        if report.get('analytics') or not report.get('timestamp') or not report.get('scores'): continue
+        results = report.get('results', [])
+        rows.append((report, report.get('correctCount', sum(1 for r in results if is_correct_answer(r))), report.get('totalQuestions', len(results))))
+        if scanned % 500 == 0: job_queue.set_progress(job['id'], {"scanned": scanned, "pending": len(rows)})
+
+    codes = list({access_code_of(report.get('userInfo', {})) for report, _, _ in rows} - {None})
+    batch_ids = {}
+    for i in range(0, len(codes), 300):
+        for snap in db.get_all([db.collection('access_codes').document(code) for code in codes[i:i + 300]]):
+            if snap.exists: batch_ids[snap.id] = snap.to_dict().get('batchId')
+
+    groups = {}
+    if rows:
+        dims = [analytics_dimensions(report.get('userInfo', {}), report['timestamp'], batch_ids) for report, _, _ in rows]
+        keys = [_rollup_id(d, 'backfill') for d in dims]
+        unique_keys, inverse = np.unique(np.array(keys), return_inverse=True)
+        g = len(unique_keys)
+        scores = np.array([[float(report['scores'].get(name, 0)) for name in ANALYTICS_SKILLS] for report, _, _ in rows])
+        meta = np.array([[report.get('metacognition', {}).get(k, 0) for k in METACOGNITION_KEYS] for report, _, _ in rows], dtype=float)
+        counts = np.bincount(inverse, minlength=g)
+        correct = np.bincount(inverse, weights=[c for _, c, _ in rows], minlength=g)
+        questions = np.bincount(inverse, weights=[q for _, _, q in rows], minlength=g)
+        sums, sum_sq, meta_sums = np.zeros((g, len(ANALYTICS_SKILLS))), np.zeros((g, len(ANALYTICS_SKILLS))), np.zeros((g, len(METACOGNITION_KEYS)))
+        np.add.at(sums, inverse, scores)
+        np.add.at(sum_sq, inverse, scores ** 2)
+        np.add.at(meta_sums, inverse, meta)
+        bins = np.clip((scores // SCORE_BIN_WIDTH).astype(int), 0, SCORE_BINS - 1)
+        hist = np.zeros((g, len(ANALYTICS_SKILLS), SCORE_BINS), dtype=int)
+        np.add.at(hist, (inverse[:, None], np.arange(len(ANALYTICS_SKILLS))[None, :], bins), 1)
+
+        first_row = {key: i for i, key in reversed(list(enumerate(keys)))}
+        for gi, key in enumerate(unique_keys.tolist()):
+            skills = {skill: {'sum': float(sums[gi, si]), 'sumSq': float(sum_sq[gi, si]), 'hist': {str(b): int(n) for b, n in enumerate(hist[gi, si]) if n}}
+                      for si, skill in enumerate(ANALYTICS_SKILLS.values())}
+            groups[key] = {**dims[first_row[key]], 'shard': 'backfill', 'count': int(counts[gi]), 'correct': int(correct[gi]), 'questions': int(questions[gi]),
+                           'skills': skills, 'metacognition': {k: int(meta_sums[gi, mi]) for mi, k in enumerate(METACOGNITION_KEYS)}}
+
+    # 지난 백필에서 만들었지만 이번에는 해당 보고서가 없는 문서는 지운다.
+    rollups = db.collection('report_rollups')
+    stale = [doc.id for doc in rollups.where(filter=FieldFilter('shard', '==', 'backfill')).select([]).stream() if doc.id not in groups]
+    operations = [('set', rollups.document(key), data) for key, data in groups.items()] + [('delete', rollups.document(doc_id), None) for doc_id in stale]
+    _, failed = bulk_write(operations)
+    if failed: raise RuntimeError(f"집계 문서 {len(failed)}개 저장 실패: {failed[0]['error']}")
+    return {"scanned": scanned, "backfilled": len(rows), "groups": len(groups), "removed": len(stale)}
+
+@app.route('/api/analytics', methods=['GET'])
+def get_analytics():
+    # 기간 안의 집계 문서만 읽어 합친다. 읽는 문서 수는 보고서 수가 아니라 (일자 x 연령대 x 배치 x 샤드)에 비례한다.
+    if not db: return jsonify({"success": False, "message": "DB 연결 실패"}), 500
+    today = datetime.now(timezone(timedelta(hours=9))).date()
+    try:
+        date_to = datetime.strptime(request.args.get('to', today.isoformat()), '%Y-%m-%d').date()
+        date_from = datetime.strptime(request.args.get('from', (date_to - timedelta(days=29)).isoformat()), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({"success": False, "message": "from/to는 YYYY-MM-DD 형식이어야 합니다."}), 400
+    if date_from > date_to or (date_to - date_from).days >= ANALYTICS_MAX_DAYS:
+        return jsonify({"success": False, "message": f"기간은 최대 {ANALYTICS_MAX_DAYS}일입니다."}), 400
+    group_by = [f for f in request.args.get('groupBy', '').split(',') if f]
+    if any(f not in ANALYTICS_GROUP_FIELDS for f in group_by):
+        return jsonify({"success": False, "message": f"groupBy는 {', '.join(ANALYTICS_GROUP_FIELDS)} 중에서 고릅니다."}), 400
+
+    try:
+        query = db.collection('report_rollups').where(filter=FieldFilter('day', '>=', date_from.isoformat())).where(filter=FieldFilter('day', '<=', date_to.isoformat()))
+        total, groups, read = _empty_rollup(), {}, 0
+        for doc in query.stream():
+            read += 1
+            rollup = doc.to_dict()
+            # 연령대/배치 조건은 복합 색인 없이 서버에서 거른다.
+            if any(request.args.get(f) and rollup.get(f) != request.args[f] for f in ('ageGroup', 'batchId')): continue
+            _merge_rollup(total, rollup)
+            if group_by: _merge_rollup(groups.setdefault(tuple(rollup.get(f) for f in group_by), _empty_rollup()), rollup)
+        response = {"success": True, "from": date_from.isoformat(), "to": date_to.isoformat(), "rollupDocsRead": read,
+                    "binWidth": SCORE_BIN_WIDTH, "total": _summarize_rollup(total)}
+        if group_by:
+            response["groups"] = [{**dict(zip(group_by, key)), **_summarize_rollup(value)} for key, value in sorted(groups.items(), key=lambda item: tuple(str(v) for v in item[0]))]
+        return jsonify(response)
+    except Exception as e:
+        app.logger.error(f"분석 집계 조회 오류: {e}", exc_info=True)
+        return jsonify({"success": False, "message": "분석 집계 조회 중 오류가 발생했습니다."}), 500
+
+@app.route('/api/analytics/backfill', methods=['POST'])
+def backfill_analytics():
+    if not db: return jsonify({"success": False, "message": "DB 연결 실패"}), 500
+    job_id = job_queue.enqueue('analytics_backfill', {}, {"scanned": 0, "pending": 0})
+    return jsonify({"success": True, "message": "집계 백필 작업이 등록되었습니다.", "jobId": job_id}), 202
+
+# --- 14. 중복 지문 탐지 ---
+# 지문을 정규화한 뒤 글자 n-gram(한국어는 어절 경계가 흐려 글자 단위가 잘 맞는다)으로 쪼개 MinHash 서명을 만들고,
+# 서명을 band로 나눈 LSH 버킷에 넣는다. 새 문제는 같은 band 버킷을 공유하는 후보만 서명으로 비교하므로 문제 은행이 커져도 조회가 전체 비교로 늘어나지 않는다.
+# 색인은 DEDUP_REBUILD_INTERVAL마다 문제 은행 캐시(question_index)에서 새로 만들고, 그 사이에는 저장/삭제할 때마다 해당 문제만 고친다.
+# 서명은 로컬 SQLite에 보관해 바뀐 지문만 다시 계산한다.
+DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', '1') == '1'
+DEDUP_THRESHOLD = float(os.environ.get('DEDUP_THRESHOLD', 0.5)) # 추정 자카드 유사도
+DEDUP_MAX_ATTEMPTS = int(os.environ.get('DEDUP_MAX_ATTEMPTS', 2)) # 중복이면 소재를 바꿔 다시 생성하는 횟수
+DEDUP_MIN_CHARS = 50 # 이보다 짧은 지문(서술형 상황 제시 등)은 n-gram이 적어 비교하지 않는다.
+DEDUP_SHINGLE_SIZE = 3
+DEDUP_NUM_PERM = 128
+DEDUP_BANDS = 32 # band당 4행. 유사도 0.5에서 후보가 될 확률 약 87%, 0.6에서 약 99%
+DEDUP_SEED = 20240917
+DEDUP_REBUILD_INTERVAL = int(os.environ.get('DEDUP_REBUILD_INTERVAL', QUESTION_CACHE_TTL))
+
+class DuplicatePassageError(ValueError):
+    pass
+
+class PassageIndex:
+    def __init__(self, threshold, num_perm, bands):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._perms = None
+        self._built_at = None
+        self._reserved_at = {} # 저장 전 예약 id -> 예약 시각
+        self._journal = [] # 마지막 재구성 이후 이 프로세스에서 저장/삭제한 문제. 재구성 중 읽은 목록에 빠진 변경을 다시 적용한다.
+        self._signatures = {} # id -> (연령대, 서명)
+        self._excerpts = {} # id -> 지문 앞부분 (다시 생성할 때 피할 소재로 알려 준다)
+        self._buckets = {} # (연령대, band 번호, band 값) -> {id}
+        self.stats = {'rebuilds': 0, 'last_rebuild_seconds': None, 'signatures_computed': 0, 'checks': 0, 'candidates_compared': 0,
+                      'duplicates_found': 0, 'regenerations': 0, 'rejected': 0, 'commits': 0, 'removals': 0}
+        local_sqlite().execute("CREATE TABLE IF NOT EXISTS passage_signatures (id TEXT PRIMARY KEY, digest TEXT NOT NULL, signature BLOB NOT NULL)")
+
+    def signature(self, passage):
+        import numpy as np # 무거운 import라 실제로 서명을 만들 때 불러온다.
+        if self._perms is None:
+            rng = np.random.default_rng(DEDUP_SEED)
+            self._perms = (rng.integers(1, 2 ** 63, self.num_perm, dtype=np.uint64) | np.uint64(1), rng.integers(0, 2 ** 63, self.num_perm, dtype=np.uint64))
+        text = re.sub(r'[\W_]+', '', (passage or '').lower()) or ' '
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        n = min(DEDUP_SHINGLE_SIZE, len(codes))
+        shingles = np.zeros(len(codes) - n + 1, dtype=np.uint64)
+        for k in range(n): shingles = shingles * np.uint64(1000003) + codes[k:len(codes) - n + 1 + k] # 2^64 에서 자연스럽게 감긴다.
+        a, b = self._perms
+        # multiply-shift 해시로 순열을 흉내 내고, 순열마다 가장 작은 값을 서명으로 쓴다.
+        return ((a[:, None] * np.unique(shingles)[None, :] + b[:, None]) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+    @staticmethod
+    def _pending_id(passage):
+        # 저장 전 예약은 지문 해시로 구분한다. 같은 지문은 서로 중복으로 걸러지므로 겹치지 않는다.
+        return f"pending-{hashlib.sha1(passage.encode('utf-8')).hexdigest()}"
+
+    def _band_keys(self, age_group, signature):
+        rows = self.num_perm // self.bands
+        return [(age_group, i, signature[i * rows:(i + 1) * rows].tobytes()) for i in range(self.bands)]
+
+    def _insert(self, doc_id, age_group, signature, passage=None):
+        self._remove(doc_id)
+        self._signatures[doc_id] = (age_group, signature)
+        if passage: self._excerpts[doc_id] = passage[:200]
+        for key in self._band_keys(age_group, signature): self._buckets.setdefault(key, set()).add(doc_id)
+
+    def _remove(self, doc_id):
+        entry = self._signatures.pop(doc_id, None)
+        self._excerpts.pop(doc_id, None)
+        self._reserved_at.pop(doc_id, None)
+        if entry is None: return
+        for key in self._band_keys(*entry):
+            bucket = self._buckets.get(key)
+            if bucket is None: continue
+            bucket.discard(doc_id)
+            if not bucket: del self._buckets[key]
+
+    def _similar(self, age_group, signature, exclude_ids=()):
+        # 같은 연령대에서 band 하나라도 겹치는 문제만 비교해 (id, 유사도) 목록을 돌려준다.
+        import numpy as np
+        candidates = set()
+        for key in self._band_keys(age_group, signature): candidates |= self._buckets.get(key, set())
+        candidates.difference_update(exclude_ids)
+        self.stats['candidates_compared'] += len(candidates)
+        matches = [(doc_id, float(np.mean(self._signatures[doc_id][1] == signature))) for doc_id in candidates]
+        return sorted([m for m in matches if m[1] >= self.threshold], key=lambda m: -m[1])
+
+    def _signatures_for(self, questions):
+        # (id, 연령대, 지문) 목록의 서명을 돌려준다. 지문이 바뀌지 않은 문제는 로컬에 보관한 서명을 다시 쓴다.
+        import numpy as np
+        conn = local_sqlite()
+        stored = {row['id']: (row['digest'], row['signature']) for row in conn.execute("SELECT id, digest, signature FROM passage_signatures")}
+        signatures, fresh = {}, []
+        for doc_id, age_group, passage in questions:
+            digest = hashlib.sha1((passage or '').encode('utf-8')).hexdigest()
+            if doc_id in stored and stored[doc_id][0] == digest:
+                signatures[doc_id] = (age_group, np.frombuffer(stored[doc_id][1], dtype=np.uint32))
+            else:
+                signatures[doc_id] = (age_group, self.signature(passage))
+                fresh.append((doc_id, digest, signatures[doc_id][1].tobytes()))
+        self.stats['signatures_computed'] += len(fresh)
+        conn.executemany("INSERT OR REPLACE INTO passage_signatures (id, digest, signature) VALUES (?, ?, ?)", fresh)
+        return signatures
+
+    def _ensure_current(self):
+        # 처음 쓸 때와 DEDUP_REBUILD_INTERVAL이 지났을 때만 문제 은행 캐시에서 색인을 새로 만든다(다른 프로세스가 저장한 문제 반영).
+        # 그 사이 이 프로세스의 저장/삭제는 commit/remove가 색인에 바로 반영한다.
+        # 재구성은 잠금 밖에서 하고, 다른 스레드가 재구성 중이면 기존 색인으로 검사를 계속한다.
+        if self._built_at is not None and time.time() - self._built_at < DEDUP_REBUILD_INTERVAL: return
+        if not self._rebuild_lock.acquire(blocking=self._built_at is None): return
+        try:
+            if self._built_at is not None and time.time() - self._built_at < DEDUP_REBUILD_INTERVAL: return
+            started = time.time()
+            with self._lock: journal_start = len(self._journal)
+            _, questions = question_index.passages()
+            signatures = self._signatures_for(questions)
+            fresh = PassageIndex(self.threshold, self.num_perm, self.bands)
+            passages = {doc_id: passage for doc_id, _, passage in questions}
+            for doc_id, (age_group, signature) in signatures.items(): fresh._insert(doc_id, age_group, signature, passages[doc_id])
+            with self._lock:
+                # 읽은 목록이 이 프로세스의 최근 변경보다 오래됐을 수 있으므로 기록해 둔 변경과 아직 저장 전인 예약을 다시 얹는다.
+                for op, doc_id, entry in self._journal:
+                    if op == 'add': fresh._insert(doc_id, *entry)
+                    else: fresh._remove(doc_id)
+                # 작업이 죽어 commit/release가 오지 않은 예약은 JOB_STALE_SECONDS가 지나면 버린다.
+                for doc_id, reserved_at in self._reserved_at.items():
+                    if time.time() - reserved_at > JOB_STALE_SECONDS: continue
+                    fresh._insert(doc_id, *self._signatures[doc_id], self._excerpts.get(doc_id))
+                    fresh._reserved_at[doc_id] = reserved_at
+                self._signatures, self._excerpts, self._buckets, self._reserved_at = fresh._signatures, fresh._excerpts, fresh._buckets, fresh._reserved_at
+                del self._journal[:journal_start]
+            self._built_at = time.time()
+            self.stats['rebuilds'] += 1
+            self.stats['last_rebuild_seconds'] = time.time() - started
+        finally:
+            self._rebuild_lock.release()
+
+    def reserve(self, question_data, exclude_id=None):
+        # 비슷한 지문이 없으면 색인에 미리 넣고 None을, 있으면 가장 비슷한 (id, 유사도, 지문 앞부분)을 돌려준다.
+        # 같은 작업에서 동시에 만든 문제끼리도 서로 걸러지도록 확인과 등록을 한 잠금 안에서 한다.
+        # 저장에 성공하면 commit, 실패하면 release를 불러 예약을 정리한다.
+        passage = question_data.get('passage') or ''
+        if len(passage) < DEDUP_MIN_CHARS: return None
+        signature = self.signature(passage)
+        self._ensure_current()
+        with self._lock:
+            self.stats['checks'] += 1
+            # 같은 후보를 다시 검사할 때(작업 재시도 등) 자기 예약과 비교하지 않는다.
+            pending_id = self._pending_id(passage)
+            matches = self._similar(question_data.get('targetAge'), signature, (exclude_id, pending_id))
+            if matches:
+                self.stats['duplicates_found'] += 1
+                return matches[0][0], matches[0][1], self._excerpts.get(matches[0][0], '')
+            self._insert(pending_id, question_data.get('targetAge'), signature, passage)
+            self._reserved_at[pending_id] = time.time()
+        return None
+
+    def commit(self, doc_id, question_data):
+        # 저장된 문제의 예약을 실제 문서 id로 옮긴다. 예약이 없으면(중복 검사를 끈 경우 등) 서명을 새로 만들어 넣는다.
+        passage = question_data.get('passage') or ''
+        if self._built_at is None or len(passage) < DEDUP_MIN_CHARS: return
+        pending_id = self._pending_id(passage)
+        with self._lock: entry = self._signatures.get(pending_id)
+        signature = entry[1] if entry else self.signature(passage)
+        with self._lock:
+            self._remove(pending_id)
+            self._insert(doc_id, question_data.get('targetAge'), signature, passage)
+            self._journal.append(('add', doc_id, (question_data.get('targetAge'), signature, passage)))
+            self.stats['commits'] += 1
+        local_sqlite().execute("INSERT OR REPLACE INTO passage_signatures (id, digest, signature) VALUES (?, ?, ?)",
+                               (doc_id, hashlib.sha1(passage.encode('utf-8')).hexdigest(), signature.tobytes()))
+
+    def release(self, question_data):
+        passage = question_data.get('passage') or ''
+        if len(passage) < DEDUP_MIN_CHARS: return
+        with self._lock: self._remove(self._pending_id(passage))
+
+    def remove(self, doc_ids):
+        if self._built_at is None: return
+        with self._lock:
+            for doc_id in doc_ids:
+                self._remove(doc_id)
+                self._journal.append(('remove', doc_id, None))
+            self.stats['removals'] += len(doc_ids)
+
+    def snapshot_stats(self):
+        return {**self.stats, 'entries': len(self._signatures), 'threshold': self.threshold, 'num_perm': self.num_perm, 'bands': self.bands,
+                'age_seconds': time.time() - self._built_at if self._built_at else None}
+
+passage_index = PassageIndex(DEDUP_THRESHOLD, DEDUP_NUM_PERM, DEDUP_BANDS)
+
+@job_queue.handler('dedup_scan')
+def run_dedup_scan_job(job):
+    # 문제 은행 전체를 LSH로 훑어 비슷한 지문끼리 묶는다. delete가 참이면 묶음마다 첫 문제만 남기고 지운다.
+    if not db: raise RuntimeError("DB 연결 실패")
+    threshold = float(job['payload'].get('threshold') or DEDUP_THRESHOLD)
+    questions = []
+    for doc in db.collection('questions').select(['targetAge', 'passage']).order_by('__name__').stream():
+        q = doc.to_dict()
+        questions.append((doc.id, q.get('targetAge'), q.get('passage')))
+    job_queue.set_progress(job['id'], {"scanned": len(questions), "status": "서명 계산 중"})
+    scan = PassageIndex(threshold, DEDUP_NUM_PERM, DEDUP_BANDS)
+    signatures = passage_index._signatures_for(questions)
+
+    # 문서 id 순으로 넣으면서 이미 들어간 비슷한 문제를 찾아, 각 문제를 가장 먼저 들어간 대표 문제에 묶는다.
+    representative, clusters = {}, {}
+    for doc_id, age_group, _ in questions:
+        age_group, signature = signatures[doc_id]
+        matches = scan._similar(age_group, signature)
+        if matches:
+            keeper = representative[matches[0][0]]
+            representative[doc_id] = keeper
+            clusters.setdefault(keeper, []).append({"id": doc_id, "similarity": round(matches[0][1], 3)})
+        else:
+            representative[doc_id] = doc_id
+        scan._insert(doc_id, age_group, signature)
+
+    duplicate_ids = [d['id'] for members in clusters.values() for d in members]
+    deleted, failed = [], []
+    if job['payload'].get('delete') and duplicate_ids:
+        deleted, failed = bulk_write([('delete', db.collection('questions').document(doc_id), None) for doc_id in duplicate_ids])
+        passage_index.remove(deleted)
+        question_index.invalidate()
+    return {"scanned": len(questions), "clusters": [{"keep": keeper, "duplicates": members} for keeper, members in clusters.items()],
+            "duplicates": len(duplicate_ids), "deleted": len(deleted), "failed": failed, "threshold": threshold}
+
+@app.route('/api/dedup-scan', methods=['POST'])
+def dedup_scan():
+    if not db: return jsonify({"success": False, "message": "DB 연결 실패"}), 500
+    data = request.get_json(silent=True) or {}
+    job_id = job_queue.enqueue('dedup_scan', {"delete": bool(data.get('delete')), "threshold": data.get('threshold')}, {"scanned": 0, "status": "대기"})
+    return jsonify({"success": True, "message": "중복 지문 검사 작업이 등록되었습니다.", "jobId": job_id}), 202
+
+# --- 15. 대량 내보내기 ---
+# 컬렉션을 문서 id 순으로 EXPORT_PAGE_SIZE개씩 끊어 읽고, 페이지마다 CSV/NDJSON 줄을 만들어 바로 흘려보낸다.
+# 한 번에 한 페이지만 메모리에 두므로 컬렉션 크기와 관계없이 메모리 사용량이 일정하다.
+# 끊기면 마지막으로 받은 id를 after로 넘겨 이어서 받는다(gzip이면 이어 받은 파일도 별도 gzip 멤버로 붙이면 된다).
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', 200))
+EXPORT_CSV_COLUMNS = {
+    'questions': [('id', lambda d: d['id']), ('category', lambda d: d.get('category')), ('targetAge', lambda d: d.get('targetAge')),
+                  ('difficulty', lambda d: d.get('difficulty')), ('type', lambda d: d.get('type')), ('title', lambda d: d.get('title')),
+                  ('question', lambda d: d.get('question')), ('passage', lambda d: d.get('passage')),
+                  ('options', lambda d: json.dumps(d.get('options') or [], ensure_ascii=False)), ('answer', lambda d: d.get('answer')),
+                  ('distractor_explanation', lambda d: d.get('distractor_explanation'))],
+    'reports': [('id', lambda d: d['id']), ('timestamp', lambda d: d.get('timestamp')), ('name', lambda d: d.get('userInfo', {}).get('name')),
+                ('age', lambda d: d.get('userInfo', {}).get('age')), ('accessCode', lambda d: access_code_of(d.get('userInfo', {}))),
+                ('batchId', lambda d: (d.get('analytics') or {}).get('batchId'))]
+               + [(name, lambda d, name=name: d.get('scores', {}).get(name)) for name in ANALYTICS_SKILLS]
+               + [('correctCount', lambda d: d.get('correctCount')), ('totalQuestions', lambda d: d.get('totalQuestions'))]
+               + [(key, lambda d, key=key: d.get('metacognition', {}).get(key)) for key in METACOGNITION_KEYS]
+               + [('reportText', lambda d: d.get('reportText'))],
+}
+# CSV에 쓰지 않는 큰 필드(reports의 results 등)는 읽지 않는다.
+EXPORT_CSV_FIELDS = {'questions': ['category', 'targetAge', 'difficulty', 'type', 'title', 'question', 'passage', 'options', 'answer', 'distractor_explanation'],
+                     'reports': ['timestamp', 'userInfo', 'analytics', 'scores', 'correctCount', 'totalQuestions', 'metacognition', 'reportText']}
+
+def _export_pages(collection, fields, after):
+    # 페이지마다 새 쿼리를 보내, 긴 스트림 하나가 타임아웃으로 끊기지 않게 한다.
+    query = db.collection(collection).order_by('__name__').limit(EXPORT_PAGE_SIZE)
+    if fields: query = query.select(fields)
+    while True:
+        page_query = query.start_after({'__name__': db.collection(collection).document(after)}) if after else query
+        page = []
+        for doc in page_query.stream():
+            data = doc.to_dict()
+            data['id'] = doc.id
+            page.append(data)
+        if page: yield page
+        if len(page) < EXPORT_PAGE_SIZE: return
+        after = page[-1]['id']
+
+def _export_lines(collection, export_format, after):
+    if export_format == 'csv':
+        columns = EXPORT_CSV_COLUMNS[collection]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if not after:
+            buffer.write('\ufeff') # 엑셀에서 한글이 깨지지 않도록 BOM을 붙인다.
+            writer.writerow([name for name, _ in columns])
+        for page in _export_pages(collection, EXPORT_CSV_FIELDS[collection], after):
+            for doc in page: writer.writerow([getter(doc) for _, getter in columns])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell(): yield buffer.getvalue()
+    else:
+        for page in _export_pages(collection, None, after):
+            yield ''.join(json.dumps(doc, ensure_ascii=False, default=str) + '\n' for doc in page)
+
+@app.route('/api/export/<collection>', methods=['GET'])
+def export_collection(collection):
+    if collection not in EXPORT_CSV_COLUMNS: return jsonify({"success": False, "message": "내보낼 수 없는 컬렉션입니다."}), 404
+    if not db: return jsonify({"success": False, "message": "DB 연결 실패"}), 500
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('csv', 'ndjson'): return jsonify({"success": False, "message": "format은 csv 또는 ndjson입니다."}), 400
+    after = request.args.get('after') or None
+    use_gzip = request.args.get('gzip') == '1'
+
+    def generate():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if use_gzip else None # wbits 31: gzip 헤더
+        pages, started = 0, time.time()
+        try:
+            for chunk in _export_lines(collection, export_format, after):
+                pages += 1
+                data = chunk.encode('utf-8')
+                if compressor: data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                if data: yield data
+            if compressor: yield compressor.flush()
+            app.logger.info(f"내보내기 완료: {collection} ({export_format}, {pages}개 페이지, {time.time() - started:.1f}초)")
+        except Exception as e:
+            # 이미 응답을 보내기 시작했으므로 상태 코드를 바꿀 수 없다. 스트림을 끊고, 받은 마지막 id부터 이어 받게 한다.
+            app.logger.error(f"내보내기 중단: {collection} ({export_format}): {e}", exc_info=True)
+            raise
+
+    extension = 'csv' if export_format == 'csv' else 'ndjson'
+    filename = f"{collection}-{datetime.now(timezone(timedelta(hours=9))).strftime('%Y%m%d-%H%M%S')}.{extension}" + ('.gz' if use_gzip else '')
+    mimetype = 'application/gzip' if use_gzip else ('text/csv; charset=utf-8' if export_format == 'csv' else 'application/x-ndjson; charset=utf-8')
+    return Response(generate(), content_type=mimetype, headers={'Content-Disposition': f'attachment; filename="{filename}"', 'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
+# --- 16. 로컬 문제 은행 ---
+# 저장소에 함께 배포되는 문제 파일(questions.json 등)을 시작할 때 읽어 (targetAge, category)별로 색인해 둔다.
+# 기본(fallback) 모드에서는 Firestore 문제 은행을 쓰고, Firestore가 죽었거나 처음 불러오는 중일 때만 로컬 문제로 시험지를 낸다.
+# Firestore 유형별 문항이 모자랄 때 로컬 문제로 채우려면 LOCAL_BANK_FILL_GAPS=1로 켠다.
+# local-first 모드에서는 로컬 문제를 먼저 쓰고 모자란 유형만 Firestore에서 읽는다(read-through). local-only는 Firestore를 쓰지 않는다.
+QUESTION_BANK_MODE = os.environ.get('QUESTION_BANK_MODE', 'fallback') # fallback | local-first | local-only
+LOCAL_QUESTION_BANKS = os.environ.get('LOCAL_QUESTION_BANKS', 'questions.json') # 쉼표로 구분한 경로 또는 glob (app.py 기준 상대 경로)
+LOCAL_BANK_FILL_GAPS = os.environ.get('LOCAL_BANK_FILL_GAPS', '0') == '1'
+# questions.json 형식(age_group/skill/difficulty)을 앱의 targetAge/category/difficulty로 옮기는 표
+LOCAL_AGE_GROUPS = {"low": "10-13", "mid": "14-16", "high": "17-19"}
+LOCAL_SKILL_CATEGORIES = {"title": "title", "comprehension": "theme", "theme": "theme", "critical_thinking": "argument",
+                          "inference": "inference", "vocabulary": "inference", "pronoun": "pronoun",
+                          "sentence_ordering": "sentence_ordering", "paragraph_ordering": "paragraph_ordering", "creativity": "essay"}
+LOCAL_DIFFICULTIES = {"easy": "기초", "medium": "표준", "hard": "심화"}
+
+def convert_local_question(item, source):
+    # 앱 형식(targetAge/category)이면 그대로 쓰고, questions.json 형식이면 옮긴다. 옮길 수 없으면 None.
+    if item.get('targetAge') and item.get('category') in CATEGORY_MAP:
+        return {**item, 'id': f"local-{source}-{item.get('id', uuid.uuid4().hex[:8])}", 'source': 'local'}
+    target_age, category = LOCAL_AGE_GROUPS.get(item.get('age_group')), LOCAL_SKILL_CATEGORIES.get(item.get('skill'))
+    if not target_age or not category: return None
+    essay = item.get('type') == 'text_input' or not item.get('options')
+    passage = item.get('passage') or '\n'.join(item.get('sentences') or item.get('paragraphs') or [])
+    options = [o['text'] if isinstance(o, dict) else o for o in item.get('options') or []]
+    feedback = {o['text']: o['feedback'] for o in item.get('options') or [] if isinstance(o, dict) and o.get('feedback')}
+    return {'id': f"local-{source}-{item.get('id')}", 'source': 'local', 'targetAge': target_age, 'category': category,
+            'difficulty': LOCAL_DIFFICULTIES.get(item.get('difficulty'), '표준'), 'type': 'essay' if essay else 'multiple_choice',
+            'title': f"[사건 파일 No.{item.get('id')}] - {CATEGORY_MAP[category]}", 'passage': passage, 'question': item.get('question', ''),
+            'options': [] if essay else options, 'answer': '' if essay else item.get('answer', ''),
+            'distractor_explanation': next(iter(feedback.values()), ''), 'optionFeedback': feedback,
+            'expectedTime': item.get('expected_time'), 'genre': item.get('genre')}
+
+class LocalQuestionBank:
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self._buckets = {}
+        self.stats = {'files': [], 'questions': 0, 'skipped': 0, 'load_errors': 0, 'tests_served': 0, 'questions_served': 0}
+
+    def load(self):
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        buckets = {}
+        for pattern in filter(None, (p.strip() for p in self.patterns.split(','))):
+            for path in sorted(glob.glob(os.path.join(base_dir, pattern))):
+                source = os.path.splitext(os.path.basename(path))[0]
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        items = json.load(f)
+                except (OSError, ValueError) as e:
+                    self.stats['load_errors'] += 1
+                    app.logger.error(f"로컬 문제 은행 읽기 실패 ({path}): {e}")
+                    continue
+                for item in items if isinstance(items, list) else items.get('questions', []):
+                    q = convert_local_question(item, source)
+                    if q is None: self.stats['skipped'] += 1
+                    else: buckets.setdefault((q['targetAge'], q['category']), []).append(q)
+                self.stats['files'].append(os.path.relpath(path, base_dir))
+        # 시험지를 만들 때 뽑기만 하면 되도록 버킷을 튜플로 굳혀 둔다.
+        self._buckets = {key: tuple(bucket) for key, bucket in buckets.items()}
+        self.stats['questions'] = sum(len(b) for b in self._buckets.values())
+        app.logger.info(f"로컬 문제 은행 로드: {self.stats['questions']}개 문항, {len(self._buckets)}개 버킷 ({', '.join(self.stats['files']) or '파일 없음'})")
+
+    def sample_test(self, age_group, test_structure):
+        questions = []
+        for category, needed_count in test_structure.items():
+            bucket = self._buckets.get((age_group, category), ())
+            questions.extend(dict(q) for q in random.sample(bucket, min(needed_count, len(bucket))))
+        if questions:
+            self.stats['tests_served'] += 1
+            self.stats['questions_served'] += len(questions)
+        return questions
+
+    def snapshot_stats(self):
+        return {**self.stats, 'mode': QUESTION_BANK_MODE, 'buckets': {f"{a}/{c}": len(v) for (a, c), v in self._buckets.items()}}
+
+local_bank = LocalQuestionBank(LOCAL_QUESTION_BANKS)
+local_bank.load()
+
+def sample_test_questions(age_group, test_structure):
+    # 앞 단계에서 유형별로 모자란 만큼만 다음 단계에서 채운다. fallback 모드에서 Firestore가 정상 응답하면
+    # LOCAL_BANK_FILL_GAPS를 켜지 않은 한 로컬 문제를 섞지 않는다.
+    if QUESTION_BANK_MODE == 'local-only': tiers = [('local', local_bank)]
+    elif QUESTION_BANK_MODE == 'local-first': tiers = [('local', local_bank), ('firestore', question_index)]
+    else: tiers = [('firestore', question_index), ('local', local_bank)]
+    questions, needed = [], dict(test_structure)
+    for source, tier in tiers:
+        if not needed: break
+        try:
+            sampled = tier.sample_test(age_group, needed)
+        except Exception as e:
+            app.logger.error(f"{source} 문제 은행에서 시험지 구성 실패, 다음 단계로 넘어감: {e}")
+            continue
+        if sampled: metrics.inc('test_questions_served_total', len(sampled), source=source)
+        questions.extend(sampled)
+        for q in sampled: needed[q['category']] -= 1
+        needed = {category: n for category, n in needed.items() if n > 0}
+        if QUESTION_BANK_MODE == 'fallback' and not LOCAL_BANK_FILL_GAPS: break
+    return questions
+
+# --- 서비스 예열 ---
+_warm_up = {'startedPid': None, 'seconds': None, 'errors': {}}
+IMPORT_SECONDS = time.time() - PROCESS_STARTED_AT
+
+def warm_up_services():
+    # 요청을 받기 전에 클라이언트를 만들고 문제 은행 캐시와 Gemini 연결을 채워 둔다. 실패해도 요청 처리 중에 다시 시도한다.
+    started = time.time()
+    steps = [('firestore', lambda: db and question_index.depths()), ('gemini', lambda: gemini.warm()), ('sheets', lambda: sheet.get())]
+    for name, step in steps:
+        try:
+            step()
+        except Exception as e:
+            _warm_up['errors'][name] = str(e)
+            app.logger.error(f"{name} 예열 실패: {e}")
+    _warm_up['seconds'] = time.time() - started
+    app.logger.info(f"서비스 예열 완료 ({_warm_up['seconds']:.2f}초, 기동 후 {time.time() - PROCESS_STARTED_AT:.2f}초)")
+
+def start_background_services():
+    # gunicorn이 fork한 워커마다 한 번씩 호출된다.
+    job_queue.start()
+    sheet_exporter.start()
+    inventory.start()
+    if _warm_up['startedPid'] != os.getpid():
+        _warm_up['startedPid'] = os.getpid()
+        threading.Thread(target=warm_up_services, name="warm-up", daemon=True).start()
+
+start_background_services()
 
 # --- 서버 실행 ---
 if __name__ == '__main__':
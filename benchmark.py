@@ -0,0 +1,633 @@
+"""시험 당일 부하 벤치마크.
+
+Flask 앱을 로컬에서 띄우고 학생 N명이 동시에 코드 확인 → 시험지 받기 → 결과 제출(→ 보고서 대기)을 하도록 트래픽을 만든다.
+외부 서비스는 모두 로컬 대역으로 바꾼다.
+  - Firestore: 메모리 가짜 DB (또는 --emulator 로 Firestore 에뮬레이터)
+  - Gemini: 지연/지터/오류율을 조절할 수 있는 가짜 HTTP 서버 (GEMINI_API_BASE 로 연결)
+  - Google Sheets: 호출 수만 세는 가짜 시트
+
+엔드포인트별 p50/p95/p99 지연, 처리량, 외부 호출 수를 출력하고 bench_results/<시각>.json 에 저장한다.
+직전 결과(또는 --compare 로 지정한 파일)와 p95를 비교해 회귀 여부를 보여준다.
+
+    python benchmark.py --students 200 --concurrency 200 --gemini-latency 2 --gemini-error-rate 0.05
+"""
+import argparse
+import copy
+import glob
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from google.api_core import exceptions as gexc
+from google.cloud.firestore_v1.transforms import Increment
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_results')
+
+# --- 가짜 Firestore ---
+# 앱이 쓰는 만큼만 흉내 낸다: 문서 get/set/update/delete/create, where/order_by/limit/select/start_after/count,
+# get_all, bulk_writer, batch, Increment, 그리고 @firestore.transactional 이 부르는 트랜잭션 내부 메서드.
+FILTER_OPERATORS = {'==': lambda a, b: a == b, '>=': lambda a, b: a is not None and a >= b, '<=': lambda a, b: a is not None and a <= b,
+                    '>': lambda a, b: a is not None and a > b, '<': lambda a, b: a is not None and a < b, 'in': lambda a, b: a in b}
+
+def merge_fields(current, data):
+    # set(merge=True)/update 처럼 중첩 맵은 필드 단위로 합치고 Increment는 기존 값에 더한다.
+    merged = dict(current)
+    for key, value in data.items():
+        if isinstance(value, Increment): merged[key] = (merged.get(key) or 0) + value.value
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict): merged[key] = merge_fields(merged[key], value)
+        elif isinstance(value, dict): merged[key] = merge_fields({}, value)
+        else: merged[key] = value
+    return merged
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+class FakeDocument:
+    def __init__(self, db, collection, doc_id):
+        self._db, self._collection, self.id = db, collection, doc_id
+
+    def get(self, transaction=None, **kwargs):
+        return self._db._read(self._collection, self.id, self)
+
+    def set(self, data, merge=False):
+        self._db._write(self._collection, self.id, data, merge=merge)
+
+    def update(self, data):
+        self._db._write(self._collection, self.id, data, merge=True, must_exist=True)
+
+    def create(self, data):
+        self._db._write(self._collection, self.id, data, must_not_exist=True)
+
+    def delete(self):
+        self._db._delete(self._collection, self.id)
+
+class FakeAggregation:
+    def __init__(self, value): self.value = value
+
+class FakeCountQuery:
+    def __init__(self, query): self._query = query
+
+    def get(self):
+        return [[FakeAggregation(len(self._query._matching(count_reads=False)))]]
+
+class FakeQuery:
+    def __init__(self, db, collection, filters=(), orders=(), limit_to=None, fields=None, cursor=None):
+        self._db, self._collection = db, collection
+        self._filters, self._orders, self._limit, self._fields, self._cursor = list(filters), list(orders), limit_to, fields, cursor
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, orders=self._orders, limit_to=self._limit, fields=self._fields, cursor=self._cursor)
+        state.update(changes)
+        return FakeQuery(self._db, self._collection, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None: field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in FILTER_OPERATORS: raise NotImplementedError(f"가짜 DB가 지원하지 않는 조건: {op_string}")
+        return self._copy(filters=self._filters + [(field_path, FILTER_OPERATORS[op_string], value)])
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + [(field_path, direction == 'DESCENDING')])
+
+    def limit(self, count): return self._copy(limit_to=count)
+
+    def select(self, field_paths): return self._copy(fields=list(field_paths))
+
+    def start_after(self, values): return self._copy(cursor=values)
+
+    def count(self): return FakeCountQuery(self)
+
+    @staticmethod
+    def _value(doc_id, data, field):
+        if field == '__name__': return doc_id
+        value = data.get(field)
+        return getattr(value, 'id', value)
+
+    def _after_cursor(self, doc_id, data):
+        for field, descending in self._orders:
+            a, b = self._value(doc_id, data, field), getattr(self._cursor.get(field), 'id', self._cursor.get(field))
+            if a == b: continue
+            return (a > b) != descending
+        return False
+
+    def _matching(self, count_reads=True):
+        with self._db._lock:
+            self._db.stats['queries'] += 1
+            items = [(doc_id, data) for doc_id, data in self._db._collections.get(self._collection, {}).items()
+                     if all(matches(data.get(field), value) for field, matches, value in self._filters)]
+        for field, descending in reversed(self._orders):
+            items.sort(key=lambda item: (self._value(*item, field) is not None, self._value(*item, field)), reverse=descending)
+        if self._cursor: items = [item for item in items if self._after_cursor(*item)]
+        if self._limit is not None: items = items[:self._limit]
+        if count_reads:
+            with self._db._lock: self._db.stats['reads'] += len(items)
+        return items
+
+    def stream(self):
+        for doc_id, data in self._matching():
+            if self._fields is not None: data = {k: v for k, v in data.items() if k in self._fields}
+            yield FakeSnapshot(FakeDocument(self._db, self._collection, doc_id), copy.deepcopy(data))
+
+    def get(self): return list(self.stream())
+
+class FakeCollection(FakeQuery):
+    def document(self, doc_id=None):
+        return FakeDocument(self._db, self._collection, doc_id or uuid.uuid4().hex[:20])
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return datetime.now(), ref
+
+class FakeTransaction:
+    # firestore.transactional 이 부르는 내부 메서드만 구현한다. 쓰기는 모아 두었다가 _commit 에서 한 번에 반영한다.
+    _max_attempts = 5
+    _read_only = False
+
+    def __init__(self, db):
+        self._db, self._id, self._writes = db, None, []
+
+    @property
+    def in_progress(self): return self._id is not None
+
+    def _clean_up(self): self._id, self._writes = None, []
+    def _begin(self, retry_id=None): self._id = uuid.uuid4().bytes
+    def _rollback(self): self._clean_up()
+
+    def _commit(self):
+        with self._db._lock:
+            for op, ref, data in self._writes:
+                if op == 'create' and ref.id in self._db._collections.get(ref._collection, {}):
+                    raise gexc.Aborted(f"이미 있는 문서: {ref.id}")
+            for op, ref, data in self._writes:
+                if op == 'delete': ref.delete()
+                else: ref.set(data, merge=(op == 'update'))
+            self._db.stats['commits'] += 1
+        self._clean_up()
+        return []
+
+    def create(self, ref, data): self._writes.append(('create', ref, data))
+    def set(self, ref, data, merge=False): self._writes.append(('set', ref, data))
+    def update(self, ref, data): self._writes.append(('update', ref, data))
+    def delete(self, ref): self._writes.append(('delete', ref, None))
+
+class FakeBatch(FakeTransaction):
+    # WriteBatch: 모아 둔 쓰기를 commit 에서 한 번에 반영하고, 이미 있는 문서를 create 하면 전체가 거절된다.
+    def commit(self):
+        with self._db._lock:
+            for op, ref, data in self._writes:
+                if op == 'create' and ref.id in self._db._collections.get(ref._collection, {}):
+                    raise gexc.AlreadyExists(f"이미 있는 문서: {ref.id}")
+            for op, ref, data in self._writes:
+                if op == 'delete': ref.delete()
+                else: ref.set(data, merge=(op == 'update'))
+        self._writes = []
+        return []
+
+    def set(self, ref, data, merge=False): self._writes.append(('update' if merge else 'set', ref, data))
+
+class FakeWriteFailure:
+    def __init__(self, reference, message):
+        self.operation = type('Operation', (), {'reference': reference})()
+        self.code, self.message, self.attempts = 6, message, 1 # 6 = ALREADY_EXISTS (재시도 대상 아님)
+
+class FakeBulkWriter:
+    def __init__(self, db):
+        self._db, self._ops, self._on_result, self._on_error = db, [], None, None
+
+    def on_write_result(self, callback): self._on_result = callback
+    def on_write_error(self, callback): self._on_error = callback
+    def create(self, ref, data): self._ops.append(('create', ref, data))
+    def set(self, ref, data, merge=False): self._ops.append(('set', ref, data))
+    def update(self, ref, data): self._ops.append(('update', ref, data))
+    def delete(self, ref): self._ops.append(('delete', ref, None))
+
+    def close(self):
+        self._db.stats['bulk_writes'] += 1
+        for op, ref, data in self._ops:
+            try:
+                if op == 'create': ref.create(data)
+                elif op == 'delete': ref.delete()
+                else: ref.set(data, merge=(op == 'update'))
+                if self._on_result: self._on_result(ref, None, self)
+            except gexc.GoogleAPICallError as e:
+                if self._on_error: self._on_error(FakeWriteFailure(ref, str(e)), self)
+        self._ops = []
+
+class FakeFirestore:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._lock = threading.RLock()
+        self._collections = {}
+        self.stats = {'reads': 0, 'writes': 0, 'deletes': 0, 'queries': 0, 'commits': 0, 'bulk_writes': 0}
+
+    def collection(self, name): return FakeCollection(self, name)
+    def transaction(self, **kwargs): return FakeTransaction(self)
+    def bulk_writer(self, **kwargs): return FakeBulkWriter(self)
+    def batch(self): return FakeBatch(self)
+
+    def get_all(self, refs, transaction=None, **kwargs):
+        return [ref.get() for ref in refs]
+
+    def _read(self, collection, doc_id, ref):
+        if self.latency: time.sleep(self.latency)
+        with self._lock:
+            self.stats['reads'] += 1
+            data = self._collections.get(collection, {}).get(doc_id)
+            return FakeSnapshot(ref, copy.deepcopy(data))
+
+    def _write(self, collection, doc_id, data, merge=False, must_exist=False, must_not_exist=False):
+        if self.latency: time.sleep(self.latency)
+        with self._lock:
+            docs = self._collections.setdefault(collection, {})
+            if must_exist and doc_id not in docs: raise gexc.NotFound(f"문서 없음: {collection}/{doc_id}")
+            if must_not_exist and doc_id in docs: raise gexc.AlreadyExists(f"이미 있는 문서: {collection}/{doc_id}")
+            docs[doc_id] = merge_fields(docs.get(doc_id, {}) if merge else {}, copy.deepcopy(dict(data)))
+            self.stats['writes'] += 1
+
+    def _delete(self, collection, doc_id):
+        with self._lock:
+            self._collections.get(collection, {}).pop(doc_id, None)
+            self.stats['deletes'] += 1
+
+# --- 가짜 Google Sheets ---
+class FakeSheet:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.stats = {'append_calls': 0, 'rows': 0}
+
+    def append_rows(self, rows, **kwargs):
+        if self.latency: time.sleep(self.latency)
+        with self._lock:
+            self.stats['append_calls'] += 1
+            self.stats['rows'] += len(rows)
+
+    def append_row(self, row, **kwargs):
+        self.append_rows([row])
+
+# --- 가짜 Gemini 서버 ---
+# generateContent, streamGenerateContent(alt=sse), 모델 목록 조회에 응답한다.
+# 문제 출제 프롬프트에는 프롬프트의 category/targetAge/type 으로 문제 JSON을, 그 밖에는 Markdown 보고서를 돌려준다.
+class FakeGemini:
+    def __init__(self, latency, jitter, error_rate, stream_chunks=8):
+        self.latency, self.jitter, self.error_rate, self.stream_chunks = latency, jitter, error_rate, stream_chunks
+        self._lock = threading.Lock()
+        self.stats = {'generate': 0, 'stream': 0, 'list_models': 0, 'errors': 0}
+        self._server = None
+
+    def count(self, key):
+        with self._lock: self.stats[key] += 1
+
+    def delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def reply_text(self, prompt):
+        category = re.search(r'"category": "(\w+)"', prompt)
+        if not category:
+            return "# 독서력 진단 보고서\n\n## 전체 결과 요약\n" + "벤치마크용 보고서 문단입니다. " * 40
+        age = re.search(r'"targetAge": "([\d-]+)"', prompt)
+        essay = '"type": "essay"' in prompt
+        options = [] if essay else [f"보기 {i} ({uuid.uuid4().hex[:6]})" for i in range(1, 5)]
+        question = {"title": f"[사건 파일 No.{random.randint(100, 999)}]", "passage": f"벤치마크 지문 {uuid.uuid4().hex} " * 10,
+                    "question": "이 글의 중심 내용으로 알맞은 것은?", "options": options, "answer": options[0] if options else "",
+                    "distractor_explanation": "" if essay else "헷갈리기 쉬운 보기입니다.", "category": category.group(1),
+                    "targetAge": age.group(1) if age else "14-16", "type": "essay" if essay else "multiple_choice"}
+        return "```json\n" + json.dumps(question, ensure_ascii=False) + "\n```"
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args): pass
+
+            def _send_json(self, status, body):
+                raw = json.dumps(body, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def do_GET(self):
+                fake.count('list_models')
+                self._send_json(200, {"models": [{"name": "models/gemini-2.5-pro"}]})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                prompt = body['contents'][0]['parts'][0]['text']
+                streaming = ':streamGenerateContent' in self.path
+                fake.count('stream' if streaming else 'generate')
+                delay = fake.delay()
+                if random.random() < fake.error_rate:
+                    time.sleep(delay / 4)
+                    fake.count('errors')
+                    return self._send_json(503, {"error": {"code": 503, "message": "fake overload"}})
+                text = fake.reply_text(prompt)
+                usage = {"promptTokenCount": len(prompt) // 4, "candidatesTokenCount": len(text) // 4, "totalTokenCount": (len(prompt) + len(text)) // 4}
+                if not streaming:
+                    time.sleep(delay)
+                    return self._send_json(200, {"candidates": [{"content": {"parts": [{"text": text}]}}], "usageMetadata": usage})
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = True
+                size = max(1, len(text) // fake.stream_chunks + 1)
+                for i in range(0, len(text), size):
+                    time.sleep(delay / fake.stream_chunks)
+                    chunk = {"candidates": [{"content": {"parts": [{"text": text[i:i + size]}]}}]}
+                    if i + size >= len(text): chunk["usageMetadata"] = usage
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n".encode())
+                    self.wfile.flush()
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-gemini", daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+# --- 측정 ---
+def parse_server_timing(header):
+    # 'firestore;dur=12.3;desc="4 calls", gemini;dur=..., app;dur=...' -> {의존성: (호출 수, ms)}. app(전체 처리 시간)은 뺀다.
+    timings = {}
+    for entry in filter(None, (e.strip() for e in (header or '').split(','))):
+        name, *params = [p.strip() for p in entry.split(';')]
+        if name == 'app': continue
+        fields = dict(p.split('=', 1) for p in params if '=' in p)
+        calls = re.match(r'"?(\d+)', fields.get('desc', ''))
+        timings[name] = (int(calls.group(1)) if calls else 1, float(fields.get('dur', 0)))
+    return timings
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.external = {} # 엔드포인트 -> 의존성 -> [호출 수, ms] (Server-Timing 헤더 합계)
+
+    def record(self, name, seconds, ok, timings=None):
+        with self._lock:
+            self.samples.setdefault(name, []).append((seconds, ok))
+            for dependency, (calls, ms) in (timings or {}).items():
+                total = self.external.setdefault(name, {}).setdefault(dependency, [0, 0.0])
+                total[0] += calls
+                total[1] += ms
+
+    def timed(self, session, name, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, timeout=300, **kwargs)
+        except requests.RequestException:
+            self.record(name, time.perf_counter() - started, False)
+            raise
+        self.record(name, time.perf_counter() - started, response.ok, parse_server_timing(response.headers.get('Server-Timing')))
+        return response
+
+def percentile(sorted_values, p):
+    if not sorted_values: return None
+    # nearest-rank
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+def summarize(recorder, wall_seconds):
+    endpoints = {}
+    for name, samples in sorted(recorder.samples.items()):
+        latencies = sorted(s for s, _ in samples)
+        endpoints[name] = {"count": len(samples), "errors": sum(1 for _, ok in samples if not ok),
+                           "p50_ms": percentile(latencies, 50) * 1000, "p95_ms": percentile(latencies, 95) * 1000,
+                           "p99_ms": percentile(latencies, 99) * 1000, "max_ms": latencies[-1] * 1000,
+                           "mean_ms": sum(latencies) / len(latencies) * 1000, "throughput_rps": len(samples) / wall_seconds,
+                           # 요청당 외부 호출 수와 시간 (앱이 보낸 Server-Timing 기준)
+                           "external": {dependency: {"calls_per_request": calls / len(samples), "ms_per_request": ms / len(samples), "calls": calls}
+                                        for dependency, (calls, ms) in sorted(recorder.external.get(name, {}).items())}}
+    return endpoints
+
+# --- 트래픽 ---
+def build_answers(questions):
+    results = []
+    for q in questions:
+        if q.get('type') == 'essay': answer = "벤치마크 학생의 서술형 답안입니다. " * random.randint(1, 4)
+        else: answer = q['answer'] if random.random() < 0.6 else random.choice(q.get('options') or [''])
+        results.append({"question": q, "answer": answer, "time": random.randint(10, 90), "confidence": random.choice(['confident', 'unsure'])})
+    return results
+
+def student_session(base, code, index, args, recorder):
+    session = requests.Session()
+    recorder.timed(session, 'POST /api/validate-code', 'POST', f"{base}/api/validate-code", json={"code": code})
+    age = random.randint(10, 19)
+    questions = recorder.timed(session, 'POST /api/get-test', 'POST', f"{base}/api/get-test", json={"age": age}).json()
+    time.sleep(random.uniform(0, args.think_time))
+    stream = random.random() < args.stream_ratio
+    submitted = time.perf_counter()
+    response = recorder.timed(session, 'POST /api/submit-result', 'POST', f"{base}/api/submit-result",
+                              json={"userInfo": {"name": f"학생{index}", "age": age, "code": code}, "results": build_answers(questions), "stream": stream})
+    report_id = response.json().get('reportId')
+    if not report_id or args.no_report_wait: return
+
+    if stream:
+        started = time.perf_counter()
+        first_token, ok, poll = None, False, False
+        with session.get(f"{base}/api/report-stream/{report_id}", stream=True, timeout=300) as events:
+            for line in events.iter_lines(decode_unicode=True):
+                if line.startswith('event: token') and first_token is None:
+                    first_token = time.perf_counter() - started
+                    recorder.record('report stream (첫 토큰)', first_token, True)
+                if line.startswith('event: poll'):
+                    poll = True
+                    break
+                if line.startswith('event: done') or line.startswith('event: error'):
+                    ok = line.startswith('event: done')
+                    break
+        recorder.record('GET /api/report-stream', time.perf_counter() - started, ok or poll)
+        # 동시 스트림 한도에 걸리면 브라우저처럼 폴링으로 넘어간다.
+        if not poll:
+            recorder.record('report ready (제출 후)', time.perf_counter() - submitted, ok)
+            return
+
+    deadline = time.time() + args.report_timeout
+    while time.time() < deadline:
+        status = recorder.timed(session, 'GET /api/report-status', 'GET', f"{base}/api/report-status/{report_id}").json()
+        if status.get('ready'):
+            recorder.record('report ready (제출 후)', time.perf_counter() - submitted, True)
+            return
+        time.sleep(args.poll_interval)
+    recorder.record('report ready (제출 후)', time.perf_counter() - submitted, False)
+
+def admin_generation(base, index, args, recorder):
+    session = requests.Session()
+    started = time.perf_counter()
+    response = recorder.timed(session, 'POST /api/generate-question-set', 'POST', f"{base}/api/generate-question-set",
+                              json={"ageGroup": random.choice(["10-13", "14-16", "17-19"]), "difficulty": "표준"})
+    job_id = response.json().get('jobId')
+    deadline = time.time() + args.report_timeout
+    while job_id and time.time() < deadline:
+        job = session.get(f"{base}/api/jobs/{job_id}", timeout=30).json().get('job', {})
+        if job.get('status') in ('done', 'failed'):
+            recorder.record('question set done (등록 후)', time.perf_counter() - started, job['status'] == 'done')
+            return
+        time.sleep(args.poll_interval)
+    recorder.record('question set done (등록 후)', time.perf_counter() - started, False)
+
+def seed_questions(app_module, per_bucket):
+    # 시험지 한 부에 필요한 유형별 문항 수보다 넉넉하게 연령대 x 유형마다 문제를 넣어 둔다.
+    fake = FakeGemini(0, 0, 0)
+    for age_group in app_module.AGE_GROUPS:
+        for category in app_module.TEST_STRUCTURE:
+            for _ in range(per_bucket):
+                question = app_module.parse_ai_json(fake.reply_text(app_module.get_detailed_prompt(category, age_group)))
+                question['difficulty'] = random.choice(app_module.DIFFICULTIES)
+                app_module.db.collection('questions').add(question)
+    # 예열 스레드가 시드 도중에 캐시를 채웠을 수 있으니 다시 읽게 한다.
+    app_module.question_index.invalidate()
+
+# --- 결과 저장 및 비교 ---
+def save_results(results):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    return path
+
+def previous_results(exclude):
+    paths = sorted(p for p in glob.glob(os.path.join(RESULTS_DIR, '*.json')) if os.path.abspath(p) != os.path.abspath(exclude))
+    return paths[-1] if paths else None
+
+def print_table(endpoints):
+    print(f"\n{'엔드포인트':<36}{'건수':>7}{'오류':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'rps':>8}  외부 호출(요청당 횟수/시간)")
+    for name, s in endpoints.items():
+        external = '  '.join(f"{dep} {e['calls_per_request']:.1f}회/{e['ms_per_request']:.1f}ms" for dep, e in s.get('external', {}).items())
+        print(f"{name:<36}{s['count']:>7}{s['errors']:>6}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}{s['p99_ms']:>10.1f}{s['throughput_rps']:>8.1f}  {external}")
+
+def compare(endpoints, baseline_path, threshold):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)['endpoints']
+    print(f"\n기준 결과와 비교: {baseline_path}")
+    regressions = []
+    for name, s in endpoints.items():
+        if name not in baseline: continue
+        before, after = baseline[name]['p95_ms'], s['p95_ms']
+        change = (after - before) / before if before else 0
+        flag = '  ← 회귀' if change > threshold else ''
+        if flag: regressions.append(name)
+        print(f"{name:<36} p95 {before:>9.1f} → {after:>9.1f} ms ({change:+.0%}){flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="독서력 진단 앱 부하 벤치마크")
+    parser.add_argument('--students', type=int, default=200, help="시험을 보는 학생 수")
+    parser.add_argument('--concurrency', type=int, default=200, help="동시에 진행하는 학생 수")
+    parser.add_argument('--admin-jobs', type=int, default=2, help="시험 중에 함께 등록할 문제 일괄 생성 작업 수")
+    parser.add_argument('--think-time', type=float, default=0.0, help="시험지를 받고 제출하기까지 최대 대기 시간(초)")
+    parser.add_argument('--stream-ratio', type=float, default=0.0, help="보고서를 SSE 스트림으로 받는 학생 비율")
+    parser.add_argument('--no-report-wait', action='store_true', help="제출 후 보고서 완성을 기다리지 않는다")
+    parser.add_argument('--report-timeout', type=float, default=300)
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--gemini-latency', type=float, default=1.0, help="가짜 Gemini 평균 응답 시간(초)")
+    parser.add_argument('--gemini-jitter', type=float, default=0.5)
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0, help="503을 돌려줄 확률")
+    parser.add_argument('--firestore-latency', type=float, default=0.0, help="가짜 Firestore 문서 읽기/쓰기 지연(초)")
+    parser.add_argument('--sheets-latency', type=float, default=0.3)
+    parser.add_argument('--emulator', help="가짜 DB 대신 쓸 Firestore 에뮬레이터 주소 (예: localhost:8081)")
+    parser.add_argument('--seed-per-bucket', type=int, default=6)
+    parser.add_argument('--compare', help="비교할 이전 결과 파일 (기본: bench_results 의 직전 결과)")
+    parser.add_argument('--regression-threshold', type=float, default=0.2, help="p95가 이 비율 이상 늘면 회귀로 표시")
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    # 앱을 import 하기 전에 가짜 Gemini 주소와 벤치마크 전용 로컬 상태 파일을 환경 변수로 넘긴다.
+    fake_gemini = FakeGemini(args.gemini_latency, args.gemini_jitter, args.gemini_error_rate)
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    os.environ.update({'GEMINI_API_BASE': fake_gemini.start(), 'GEMINI_API_KEY': 'bench', 'JOB_DB_PATH': os.path.join(workdir, 'jobs.sqlite3')})
+    os.environ.setdefault('INVENTORY_AUTOFILL', '0')
+    os.environ.setdefault('SHEET_FLUSH_INTERVAL', '2')
+    if args.emulator: os.environ['FIRESTORE_EMULATOR_HOST'] = args.emulator
+
+    import app as app_module
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app_module.app.logger.setLevel(logging.WARNING)
+
+    if args.emulator:
+        from google.auth.credentials import AnonymousCredentials
+        from google.cloud import firestore as gcf
+        fake_db = gcf.Client(project=f"bench-{uuid.uuid4().hex[:6]}", credentials=AnonymousCredentials())
+    else:
+        fake_db = FakeFirestore(args.firestore_latency)
+    fake_sheet = FakeSheet(args.sheets_latency)
+    app_module.db.set(fake_db)
+    app_module.sheet.set(fake_sheet)
+
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-app", daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    print(f"준비: 문제 시드 {args.seed_per_bucket}개/버킷, 접근 코드 {args.students}개 발급")
+    seed_questions(app_module, args.seed_per_bucket)
+    codes = []
+    while len(codes) < args.students:
+        minted = requests.post(f"{base}/api/generate-codes", json={"count": min(app_module.MINT_MAX_CODES, args.students - len(codes))}, timeout=60).json()
+        codes.extend(minted['codes'])
+
+    # 시드와 발급에 든 호출은 빼고 시험 구간만 센다.
+    if isinstance(fake_db, FakeFirestore):
+        for key in fake_db.stats: fake_db.stats[key] = 0
+    for key in fake_gemini.stats: fake_gemini.stats[key] = 0
+
+    print(f"시작: 학생 {args.students}명 (동시 {args.concurrency}), 문제 일괄 생성 {args.admin_jobs}건")
+    recorder = Recorder()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency + args.admin_jobs) as executor:
+        futures = [executor.submit(admin_generation, base, i, args, recorder) for i in range(args.admin_jobs)]
+        futures += [executor.submit(student_session, base, code, i, args, recorder) for i, code in zip(itertools.count(1), codes)]
+        failures = 0
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                print(f"세션 실패: {e}", file=sys.stderr)
+    wall_seconds = time.perf_counter() - started
+    app_module.sheet_exporter.flush(force=True)
+
+    endpoints = summarize(recorder, wall_seconds)
+    results = {
+        "startedAt": datetime.now().isoformat(timespec='seconds'), "wallSeconds": wall_seconds, "sessionFailures": failures,
+        "config": vars(args),
+        "endpoints": endpoints,
+        "external": {"firestore": getattr(fake_db, 'stats', None), "gemini": fake_gemini.stats, "sheets": fake_sheet.stats},
+        "systemStats": requests.get(f"{base}/api/system-stats", timeout=30).json(),
+    }
+    server.shutdown()
+
+    print_table(endpoints)
+    print(f"\n총 {wall_seconds:.1f}초, 세션 실패 {failures}건")
+    print(f"외부 호출 합계(가짜 서비스 기준): {json.dumps(results['external'], ensure_ascii=False)}")
+    path = save_results(results)
+    print(f"결과 저장: {path}")
+
+    baseline = args.compare or previous_results(path)
+    regressions = compare(endpoints, baseline, args.regression_threshold) if baseline else []
+    if regressions and args.fail_on_regression: sys.exit(1)
+
+if __name__ == '__main__':
+    main()
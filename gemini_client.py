@@ -0,0 +1,173 @@
+"""Gemini API 클라이언트.
+
+모든 Gemini 호출(문제 생성, 보고서 작성, 보고서 스트리밍)이 거치는 클라이언트를 모아 둔다.
+지표와 로그는 on_event/logger 훅으로 앱에 넘기므로 이 모듈은 Flask 앱에 의존하지 않는다.
+"""
+import os
+import json
+import time
+import random
+import logging
+import threading
+import requests
+
+GEMINI_API_BASE = os.environ.get('GEMINI_API_BASE', "https://generativelanguage.googleapis.com/v1")
+GEMINI_TIMEOUT = int(os.environ.get('GEMINI_TIMEOUT', 180))
+GEMINI_MAX_RETRIES = int(os.environ.get('GEMINI_MAX_RETRIES', 2))
+GEMINI_POOL_SIZE = int(os.environ.get('GEMINI_POOL_SIZE', 32))
+GEMINI_BREAKER_THRESHOLD = int(os.environ.get('GEMINI_BREAKER_THRESHOLD', 5))
+GEMINI_BREAKER_COOLDOWN = float(os.environ.get('GEMINI_BREAKER_COOLDOWN', 30))
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 40, 60, 120, 180)
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+class GeminiClient:
+    # 모든 Gemini 호출이 거치는 클라이언트. keep-alive 세션을 재사용하고,
+    # 재시도 가능한 오류(429/5xx, 연결 오류)만 지터를 섞은 지수 백오프로 재시도하며,
+    # 연속 실패가 임계치를 넘으면 쿨다운 동안 호출하지 않고 바로 실패시킨다(circuit breaker).
+    BASE_URL = f"{GEMINI_API_BASE}/models"
+
+    def __init__(self, api_key, timeout, max_retries, pool_size, breaker_threshold, breaker_cooldown, logger=None, on_event=None):
+        # on_event(event, model_name, **fields): 호출마다 'call'(elapsed, error, usage), 재시도마다 'retry', 차단마다 'rejected'를 알린다.
+        self.api_key = api_key
+        self.logger = logger or logging.getLogger(__name__)
+        self.on_event = on_event or (lambda event, model_name, **fields: None)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._open_until = 0
+        self._half_open_trial = False
+        self.models = {}
+
+    def _model_stats(self, model_name):
+        return self.models.setdefault(model_name, {
+            'calls': 0, 'errors': 0, 'retries': 0, 'rejected': 0,
+            'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'latency_sum': 0.0,
+            'prompt_tokens': 0, 'candidates_tokens': 0, 'total_tokens': 0})
+
+    def _before_call(self, model_name):
+        with self._lock:
+            if self._open_until and time.time() < self._open_until:
+                self._model_stats(model_name)['rejected'] += 1
+                self.on_event('rejected', model_name)
+                raise CircuitOpenError("AI 서버 장애로 호출을 일시 중단했습니다.")
+            if self._open_until:
+                # 쿨다운이 끝나면 한 번만 시험 호출을 보내고, 나머지는 결과가 나올 때까지 막는다.
+                if self._half_open_trial:
+                    self._model_stats(model_name)['rejected'] += 1
+                    self.on_event('rejected', model_name)
+                    raise CircuitOpenError("AI 서버 장애로 호출을 일시 중단했습니다.")
+                self._half_open_trial = True
+
+    def _record(self, model_name, elapsed, ok, usage=None, upstream_failure=False):
+        with self._lock:
+            stats = self._model_stats(model_name)
+            stats['calls'] += 1
+            stats['latency_sum'] += elapsed
+            stats['latency_buckets'][next((i for i, bound in enumerate(LATENCY_BUCKETS) if elapsed <= bound), len(LATENCY_BUCKETS))] += 1
+            if not ok: stats['errors'] += 1
+            for key, field in (('prompt_tokens', 'promptTokenCount'), ('candidates_tokens', 'candidatesTokenCount'), ('total_tokens', 'totalTokenCount')):
+                stats[key] += (usage or {}).get(field, 0)
+            if upstream_failure:
+                self._consecutive_failures += 1
+                if self._half_open_trial or self._consecutive_failures >= self.breaker_threshold:
+                    self._open_until = time.time() + self.breaker_cooldown
+                    self.logger.error(f"AI 서버 연속 실패 {self._consecutive_failures}회, {self.breaker_cooldown:.0f}초간 호출 중단")
+                self._half_open_trial = False
+            else:
+                self._consecutive_failures = 0
+                self._open_until = 0
+                self._half_open_trial = False
+        self.on_event('call', model_name, elapsed=elapsed, error=None if ok else ('upstream' if upstream_failure else 'request'), usage=usage or {})
+
+    def generate(self, prompt, model_name, timeout=None, deadline=None):
+        # 응답 텍스트와 usageMetadata를 함께 돌려준다. deadline(절대 시각)을 넘기면 더 이상 재시도하지 않는다.
+        if not self.api_key: raise ValueError("GEMINI_API_KEY가 설정되지 않았습니다.")
+        url = f"{self.BASE_URL}/{model_name}:generateContent"
+        data = {'contents': [{'parts': [{'text': prompt}]}]}
+        for attempt in range(self.max_retries + 1):
+            call_timeout = timeout or self.timeout
+            if deadline:
+                call_timeout = min(call_timeout, deadline - time.time())
+                if call_timeout <= 0: raise TimeoutError("AI 호출 제한 시간을 초과했습니다.")
+            self._before_call(model_name)
+            started = time.time()
+            try:
+                response = self.session.post(url, params={'key': self.api_key}, data=json.dumps(data), timeout=call_timeout)
+                retryable = response.status_code in RETRYABLE_STATUS_CODES
+                result = response.json() if response.ok else {}
+            except (requests.RequestException, ValueError):
+                # 연결 오류, 끊긴 응답 본문, JSON이 아닌 응답 모두 상류 장애로 기록해야 시험 호출 표시가 풀린다.
+                self._record(model_name, time.time() - started, ok=False, upstream_failure=True)
+                if attempt == self.max_retries: raise
+                self.logger.warning(f"AI 호출 재시도 ({attempt + 1}/{self.max_retries}): 연결 또는 응답 오류", exc_info=True)
+            else:
+                self._record(model_name, time.time() - started, ok=response.ok, usage=result.get('usageMetadata'), upstream_failure=retryable)
+                if not retryable or attempt == self.max_retries:
+                    response.raise_for_status()
+                    if not result.get('candidates'): raise ValueError(f"AI가 유효한 응답을 생성하지 못했습니다. 응답 내용: {result}")
+                    return result['candidates'][0]['content']['parts'][0]['text'], result.get('usageMetadata', {})
+                self.logger.warning(f"AI 호출 재시도 ({attempt + 1}/{self.max_retries}): HTTP {response.status_code}")
+            self._model_stats(model_name)['retries'] += 1
+            self.on_event('retry', model_name)
+            backoff = random.uniform(0.5, 1.5) * 2 ** attempt
+            if deadline and time.time() + backoff >= deadline: raise TimeoutError("AI 호출 제한 시간을 초과했습니다.")
+            time.sleep(backoff)
+
+    def stream(self, prompt, model_name, timeout=None):
+        # streamGenerateContent(SSE) 응답을 받아 텍스트 조각을 차례로 내보낸다. 스트림 도중에는 재시도하지 않는다.
+        if not self.api_key: raise ValueError("GEMINI_API_KEY가 설정되지 않았습니다.")
+        url = f"{self.BASE_URL}/{model_name}:streamGenerateContent"
+        data = {'contents': [{'parts': [{'text': prompt}]}]}
+        self._before_call(model_name)
+        started = time.time()
+        try:
+            response = self.session.post(url, params={'key': self.api_key, 'alt': 'sse'}, data=json.dumps(data), timeout=timeout or self.timeout, stream=True)
+        except requests.RequestException:
+            self._record(model_name, time.time() - started, ok=False, upstream_failure=True)
+            raise
+        if not response.ok:
+            self._record(model_name, time.time() - started, ok=False, upstream_failure=response.status_code in RETRYABLE_STATUS_CODES)
+            # stream=True 응답은 닫아야 keep-alive 연결이 풀로 돌아간다.
+            response.close()
+            response.raise_for_status()
+
+        response.encoding = 'utf-8'
+        ok, usage, upstream_failure = False, None, False
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'): continue
+                chunk = json.loads(line[5:])
+                usage = chunk.get('usageMetadata', usage)
+                for part in (chunk.get('candidates') or [{}])[0].get('content', {}).get('parts', []):
+                    if part.get('text'): yield part['text']
+            ok = True
+        except (requests.RequestException, ValueError):
+            upstream_failure = True
+            raise
+        finally:
+            # 클라이언트가 중간에 끊은 경우(GeneratorExit)도 여기서 기록되어 시험 호출 표시가 풀린다.
+            response.close()
+            self._record(model_name, time.time() - started, ok=ok, usage=usage, upstream_failure=upstream_failure)
+
+    def warm(self):
+        # 모델 목록을 한 번 조회해 keep-alive 연결(TLS 포함)을 미리 열어 둔다.
+        if not self.api_key: return
+        self.session.get(self.BASE_URL, params={'key': self.api_key, 'pageSize': 1}, timeout=10).raise_for_status()
+
+    def snapshot_stats(self):
+        with self._lock:
+            return {'circuit_open': bool(self._open_until and time.time() < self._open_until),
+                    'consecutive_failures': self._consecutive_failures,
+                    'latency_bucket_bounds': LATENCY_BUCKETS,
+                    'models': json.loads(json.dumps(self.models))}